@@ -0,0 +1,498 @@
+"""Benchmark del bot con server finti per l'API contents di GitHub e per la Bot API di Telegram.
+
+Simula migliaia di utenti che usano /apri, /collezione, /riscatta e /reset passando dal vero
+percorso webhook dell'Application, e riporta throughput, latenze p50/p95/p99 e numero di
+chiamate a GitHub per comando.
+
+Alla fine esegue uno stress test: ogni utente invia una raffica di /apri contemporanei e si verifica
+che la riserva di pacchetti sia coerente (nessun pacchetto speso due volte o perso).
+
+Uso: python benchmark.py [--utenti 1000] [--concorrenza 50] [--raffica 15] [--seed 1] [--json risultati.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+from base64 import b64decode, b64encode
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_CODE = "BENCHCODE"
+
+
+class FakeGitHub:
+    """Finto endpoint /repos/<repo>/contents/<path> di GitHub: file (JSON base64 o raw), elenco delle
+    cartelle, PUT con semantica sha ed ETag."""
+
+    def __init__(self):
+        self.files = {}  # path -> (contenuto in bytes, sha)
+        self.calls = {}  # metodo -> numero di richieste
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=None, headers=None, raw=None):
+                if raw is not None:
+                    data, content_type = raw, "application/octet-stream"
+                else:
+                    data, content_type = (json.dumps(body).encode("utf-8") if body is not None else b""), "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _path(self):
+                match = re.match(r"^/repos/[^/]+/[^/]+/contents/(.+)$", urlparse(self.path).path)
+                return match.group(1) if match else None
+
+            def do_GET(self):
+                fake.count("GET")
+                path = self._path()
+                with fake.lock:
+                    entry = fake.files.get(path)
+                    listing = [
+                        {"type": "file", "name": name[len(path) + 1:], "path": name, "sha": sha, "size": len(content)}
+                        for name, (content, sha) in sorted(fake.files.items())
+                        if name.startswith(f"{path}/") and "/" not in name[len(path) + 1:]
+                    ]
+                if entry is None:
+                    if listing:
+                        self._reply(200, listing)
+                    else:
+                        self._reply(404, {"message": "Not Found"})
+                    return
+                content, sha = entry
+                etag = f'"{sha}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._reply(304, headers={"ETag": etag})
+                    return
+                if "raw" in self.headers.get("Accept", ""):
+                    self._reply(200, headers={"ETag": etag}, raw=content)
+                    return
+                self._reply(200, {
+                    "path": path,
+                    "sha": sha,
+                    "encoding": "base64",
+                    "content": b64encode(content).decode("ascii"),
+                }, {"ETag": etag})
+
+            def do_PUT(self):
+                fake.count("PUT")
+                path = self._path()
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with fake.lock:
+                    entry = fake.files.get(path)
+                    if entry is not None and payload.get("sha") != entry[1]:
+                        status, body = 409, {"message": f"{path} does not match {payload.get('sha')}"}
+                    elif entry is None and payload.get("sha"):
+                        status, body = 422, {"message": "sha wasn't supplied for a new file"}
+                    else:
+                        sha = fake.put(path, b64decode(payload["content"]))
+                        status, body = (200 if entry else 201), {"content": {"path": path, "sha": sha}}
+                self._reply(status, body)
+
+            def do_DELETE(self):
+                fake.count("DELETE")
+                path = self._path()
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with fake.lock:
+                    entry = fake.files.get(path)
+                    if entry is None:
+                        status, body = 404, {"message": "Not Found"}
+                    elif payload.get("sha") != entry[1]:
+                        status, body = 409, {"message": f"{path} does not match {payload.get('sha')}"}
+                    else:
+                        del fake.files[path]
+                        status, body = 200, {"content": None}
+                self._reply(status, body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def put(self, path, content):
+        sha = sha1(b"blob %d\0" % len(content) + content).hexdigest()
+        self.files[path] = (content, sha)
+        return sha
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class FakeTelegram:
+    """Finta Bot API di Telegram: risponde ai metodi usati dal bot e segnala le risposte per chat."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {}  # chat_id -> asyncio.Future in attesa della prossima risposta
+        self.outbox = {}  # chat_id -> testi (o didascalie) inviati alla chat
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.message_id = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = urlparse(self.path).path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = fake.parse(self.headers.get("Content-Type", ""), body)
+                result = fake.handle(method, params)
+                data = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    @staticmethod
+    def parse(content_type, body):
+        if content_type.startswith("multipart/form-data"):
+            fields = re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S)
+            return {name.decode(): value.decode("utf-8", "replace") for name, value in fields}
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+
+    def message(self, chat_id, **extra):
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        message.update(extra)
+        return message
+
+    def photo(self, chat_id):
+        file_id = f"photo-{chat_id}-{time.monotonic_ns()}"
+        return self.message(chat_id, photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}])
+
+    def handle(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id not in (None, "") else None
+        if method in ("sendMessage", "editMessageText"):
+            result = self.message(chat_id, text=params.get("text", ""))
+        elif method == "sendPhoto":
+            result = self.photo(chat_id)
+        elif method == "sendMediaGroup":
+            media = params.get("media")
+            count = len(json.loads(media)) if isinstance(media, str) else len(media or [])
+            result = [self.photo(chat_id) for _ in range(count)]
+        else:
+            return True
+        if chat_id is not None:
+            with self.lock:
+                self.outbox.setdefault(chat_id, []).append(params.get("text") or params.get("caption") or method)
+            self.loop.call_soon_threadsafe(self.notify, chat_id)
+        return result
+
+    def notify(self, chat_id):
+        waiter = self.waiters.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    def expect(self, chat_id):
+        """Future risolta alla prossima chiamata in uscita verso la chat."""
+        waiter = self.loop.create_future()
+        self.waiters[chat_id] = waiter
+        return waiter
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class LoadGenerator:
+    """Invia update finti al webhook del bot e misura il tempo fino alla prima risposta verso la chat."""
+
+    def __init__(self, webhook_url, telegram, client, timeout):
+        self.webhook_url = webhook_url
+        self.telegram = telegram
+        self.client = client
+        self.timeout = timeout
+        self.update_id = 0
+
+    def _next_update_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def command(self, user_id, text):
+        command = text.split()[0]
+        return {
+            "update_id": self._next_update_id(),
+            "message": {
+                "message_id": self._next_update_id(),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"Utente{user_id}"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        }
+
+    def callback(self, user_id, data):
+        user = {"id": user_id, "is_bot": False, "first_name": f"Utente{user_id}"}
+        return {
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                "id": str(self._next_update_id()),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": self._next_update_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "conferma",
+                },
+            },
+        }
+
+    async def send(self, user_id, update):
+        """Invia l'update e ritorna la latenza in secondi fino alla risposta del bot."""
+        waiter = self.telegram.expect(user_id)
+        start = time.perf_counter()
+        response = await self.client.post(self.webhook_url, json=update)
+        response.raise_for_status()
+        answered = await asyncio.wait_for(waiter, self.timeout)
+        return answered - start
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_phase(name, users, concurrency, action, github):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(user_id):
+        nonlocal errors
+        async with semaphore:
+            try:
+                latencies.append(await action(user_id))
+            except Exception:
+                errors += 1
+
+    github_before = github.total_calls()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in users))
+    elapsed = time.perf_counter() - start
+    github_calls = github.total_calls() - github_before
+    return {
+        "comando": name,
+        "comandi": len(users),
+        "errori": errors,
+        "durata_s": elapsed,
+        "throughput": len(users) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "github_per_comando": github_calls / len(users) if users else 0.0,
+    }
+
+
+async def stress_test(generator, telegram, bot, users, burst, concurrency, timeout):
+    """Invia a ogni utente una raffica di /apri contemporanei e controlla che i pacchetti aperti siano
+    esattamente quelli disponibili e che la riserva finale sia corretta."""
+    initial_reserve = bot.new_user_collection().pack_reserve
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(user_id):
+        async with semaphore:
+            response = await generator.client.post(generator.webhook_url, json=generator.command(user_id, "/apri"))
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(post(user_id) for _ in range(burst) for user_id in users))
+    deadline = time.monotonic() + timeout
+    while any(len(telegram.outbox.get(user_id, ())) < burst for user_id in users) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    inconsistent = []
+    for user_id in users:
+        replies = telegram.outbox.get(user_id, [])
+        refused = sum(1 for text in replies if text.startswith("Non hai pacchetti"))
+        collection = bot.user_collections.get(str(user_id))
+        if (
+            collection is None
+            or len(replies) != burst
+            or burst - refused != min(burst, initial_reserve)
+            or collection.pack_reserve != max(0, initial_reserve - burst)
+        ):
+            inconsistent.append(user_id)
+    return {
+        "utenti": len(users),
+        "raffica": burst,
+        "durata_s": elapsed,
+        "incoerenti": len(inconsistent),
+        "esempi_incoerenti": inconsistent[:10],
+    }
+
+
+def print_report(results, startup_calls, shutdown_calls):
+    print(f"\n{'comando':<12}{'n':>7}{'err':>6}{'cmd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'GitHub/cmd':>12}")
+    for result in results:
+        print(f"{result['comando']:<12}{result['comandi']:>7}{result['errori']:>6}{result['throughput']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+              f"{result['github_per_comando']:>12.3f}")
+    print(f"\nChiamate GitHub all'avvio: {startup_calls}, allo spegnimento: {shutdown_calls}")
+
+
+async def benchmark(args):
+    loop = asyncio.get_running_loop()
+    github = FakeGitHub()
+    telegram = FakeTelegram(loop)
+    github.start()
+    telegram.start()
+
+    # La configurazione del bot va impostata prima di importarlo
+    workdir = tempfile.mkdtemp(prefix="sbit-bench-")
+    os.environ["GITHUB_API_URL"] = github.url
+    os.environ["GITHUB_TOKEN"] = "bench"
+    os.environ["DB_PATH"] = os.path.join(workdir, "collezioni.db")
+    os.environ.setdefault("SAVE_INTERVAL", str(args.intervallo_salvataggio))
+    if not args.limiti_telegram:
+        # Misuriamo il bot, non i limiti di Telegram: scheduler e anti-spam senza freni
+        os.environ.setdefault("GLOBAL_SEND_RATE", "1000000")
+        os.environ.setdefault("CHAT_SEND_RATE", "1000000")
+        os.environ.setdefault("GROUP_SEND_RATE", "1000000")
+        os.environ.setdefault("APRI_COOLDOWN", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    import bot
+    import httpx
+
+    if not args.verbose:
+        bot.print = lambda *a, **k: None
+
+    bot.random.seed(args.seed)
+    github.put(bot.GITHUB_FILE_PATH, b"{}")
+    github.put(bot.GITHUB_CODES_FILE_PATH, json.dumps({
+        "valid_codes": {BENCH_CODE: {"reward": "10_pacchetti"}},
+        "used_codes": {},
+    }).encode("utf-8"))
+
+    port = free_port()
+    webhook_url = f"http://127.0.0.1:{port}/bench"
+    application = bot.build_application(BENCH_TOKEN, base_url=telegram.url)
+    await application.initialize()
+    calls_before = github.total_calls()
+    await bot.post_init(application)
+    await bot.startup.ready.wait()
+    startup_calls = github.total_calls() - calls_before
+    await application.updater.start_webhook(listen="127.0.0.1", port=port, url_path="bench", webhook_url=webhook_url)
+    await application.start()
+
+    users = [100000 + index for index in range(args.utenti)]
+    results = []
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        generator = LoadGenerator(webhook_url, telegram, client, args.timeout)
+
+        async def reset(user_id):
+            first = await generator.send(user_id, generator.command(user_id, "/reset"))
+            second = await generator.send(user_id, generator.callback(user_id, "reset_yes"))
+            return first + second
+
+        phases = [
+            ("/apri", lambda user_id: generator.send(user_id, generator.command(user_id, "/apri"))),
+            ("/collezione", lambda user_id: generator.send(user_id, generator.command(user_id, "/collezione"))),
+            ("/riscatta", lambda user_id: generator.send(user_id, generator.command(user_id, f"/riscatta {BENCH_CODE}"))),
+            ("/reset", reset),
+        ]
+        for name, action in phases:
+            for _ in range(args.ripetizioni):
+                results.append(await run_phase(name, users, args.concorrenza, action, github))
+
+        stress = None
+        if args.raffica:
+            # Utenti nuovi, così la riserva iniziale è nota
+            stress_users = [200000 + index for index in range(args.utenti)]
+            stress = await stress_test(generator, telegram, bot, stress_users, args.raffica, args.concorrenza, args.timeout)
+
+    await application.updater.stop()
+    await application.stop()
+    calls_before = github.total_calls()
+    await bot.post_shutdown(application)
+    shutdown_calls = github.total_calls() - calls_before
+    await application.shutdown()
+
+    github.stop()
+    telegram.stop()
+
+    print_report(results, startup_calls, shutdown_calls)
+    if stress is not None:
+        print(f"Stress test: {stress['utenti']} utenti x {stress['raffica']} /apri contemporanei in "
+              f"{stress['durata_s']:.1f}s, utenti con pacchetti incoerenti: {stress['incoerenti']}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"risultati": results, "github_avvio": startup_calls, "github_spegnimento": shutdown_calls,
+                       "stress": stress}, file, indent=4)
+    if stress is not None and stress["incoerenti"]:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--utenti", type=int, default=1000, help="numero di utenti simulati")
+    parser.add_argument("--concorrenza", type=int, default=50, help="comandi in volo contemporaneamente")
+    parser.add_argument("--ripetizioni", type=int, default=1, help="quante volte ripetere ogni comando per utente")
+    parser.add_argument("--timeout", type=float, default=30.0, help="attesa massima per una risposta (secondi)")
+    parser.add_argument("--intervallo-salvataggio", type=int, default=300, help="SAVE_INTERVAL usato dal bot")
+    parser.add_argument("--raffica", type=int, default=15, help="/apri contemporanei per utente nello stress test (0 per saltarlo)")
+    parser.add_argument("--limiti-telegram", action="store_true", help="mantiene i limiti di invio reali e l'anti-spam di /apri")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="salva i risultati in un file JSON")
+    parser.add_argument("--verbose", action="store_true", help="mostra i log del bot")
+    asyncio.run(benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,59 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 import os
 import random
 import json
 import re
+import time
+import hashlib
+import gzip
+import zlib
+import heapq
+import io
+import math
+import asyncio
+import sqlite3
+import threading
+import functools
+import secrets
 import requests
+import tornado.web
+from PIL import Image, ImageEnhance, ImageOps
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from contextlib import ExitStack, asynccontextmanager
+from itertools import accumulate, count
 from datetime import datetime, timedelta
 from base64 import b64decode, b64encode
 
 GITHUB_REPO = "Raffos1/sbit-album"
-GITHUB_FILE_PATH = "user_collections.json"
+GITHUB_FILE_PATH = "user_collections.json"  # Vecchio snapshot in un unico file, letto solo per la migrazione
+GITHUB_SNAPSHOT_DIR = "snapshot"
 GITHUB_CODES_FILE_PATH = "codes.json"
+GITHUB_CODE_BATCHES_DIR = "codici/lotti"     # Un file per lotto di codici monouso (solo hash)
+GITHUB_REDEMPTIONS_DIR = "codici/riscatti"   # Log dei riscatti: ogni salvataggio aggiunge un nuovo segmento
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+
+# ID Telegram degli amministratori (separati da virgola)
+ADMIN_IDS = {admin_id.strip() for admin_id in os.environ.get("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
+# Archivio locale: ogni modifica viene scritta subito qui, un record per utente
+DB_PATH = os.environ.get("DB_PATH", "collezioni.db")
+
+# Numero di shard dello snapshot su GitHub: non va cambiato dopo il primo salvataggio
+SNAPSHOT_SHARDS = int(os.environ.get("SNAPSHOT_SHARDS", 16))
+
+# Chiave segreta con cui vengono calcolati gli hash dei codici monouso: se cambia, i codici già generati non valgono più.
+# Senza chiave i codici monouso sono disattivati: gli hash nel repository si potrebbero invertire per forza bruta
+CODES_SECRET = os.environ.get("CODES_SECRET", "")
+
+# Intervallo (in secondi) tra uno snapshot su GitHub e il successivo
+SAVE_INTERVAL = int(os.environ.get("SAVE_INTERVAL", 300))
 
 # File delle carte organizzati per rarità
 CARD_FILES = {
@@ -21,6 +63,10 @@ CARD_FILES = {
     "leggendaria": "leggendarie.txt"
 }
 
+# Cartella delle immagini delle carte e ogni quanti secondi controllare se catalogo o immagini sono cambiati
+IMAGE_DIR = "immagini"
+CATALOG_POLL_INTERVAL = int(os.environ.get("CATALOG_POLL_INTERVAL", 30))
+
 # Probabilità per le rarità (in percentuale)
 RARITY_PROBABILITIES = {
     "comune": 78,
@@ -29,91 +75,2279 @@ RARITY_PROBABILITIES = {
     "leggendaria": 2
 }
 
-# Collezione utenti
+# Economia dei pacchetti: riserva iniziale, tetto della ricarica e ricarica ogni REFILL_INTERVAL
+INITIAL_PACKS = 10
+MAX_PACK_RESERVE = 10
+PACKS_PER_REFILL = 5
+REFILL_INTERVAL = timedelta(hours=12)
+
+# Numero massimo di pacchetti apribili con un solo /apri (limite degli album di Telegram)
+MAX_PACKS_PER_COMMAND = 10
+
+# Limiti di invio verso Telegram (messaggi al secondo): globale, per chat privata e per gruppo
+GLOBAL_SEND_RATE = float(os.environ.get("GLOBAL_SEND_RATE", 30))
+CHAT_SEND_RATE = float(os.environ.get("CHAT_SEND_RATE", 1))
+GROUP_SEND_RATE = float(os.environ.get("GROUP_SEND_RATE", 20 / 60))
+CHAT_SEND_BURST = 3
+SEND_MAX_RETRIES = 3
+
+# Secondi minimi tra due /apri dello stesso utente: i comandi in eccesso vengono ignorati
+APRI_COOLDOWN = float(os.environ.get("APRI_COOLDOWN", 2))
+
+# Update gestiti in parallelo (quelli dello stesso utente restano in fila, vedi serialized())
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+# Quanto un update aspetta che il bot finisca di caricare lo stato prima di chiedere di riprovare
+STARTUP_WAIT_TIMEOUT = float(os.environ.get("STARTUP_WAIT_TIMEOUT", 60))
+STARTUP_MAX_BACKOFF = 60
+
+# Porta dell'endpoint /metrics in formato Prometheus (disattivato se non configurata)
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+class Metrics:
+    """Registro minimale di metriche in formato Prometheus: contatori, gauge e istogrammi con etichette."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []  # Funzioni chiamate prima di ogni esportazione per aggiornare i gauge
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(self.BUCKETS) + [0, 0.0]
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                print(f"Errore nel calcolo delle metriche: {e}")
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                declared = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in declared:
+                        lines.append(f"# TYPE {name} {kind}")
+                        declared.add(name)
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+            declared = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in declared:
+                    lines.append(f"# TYPE {name} histogram")
+                    declared.add(name)
+                for bound, count in zip(self.BUCKETS, histogram):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram[-2]}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram[-2]}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def github_request(method, url, **kwargs):
+    """Esegue una richiesta all'API di GitHub registrando latenza, esito e rate limit residuo."""
+    start = time.monotonic()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except Exception:
+        metrics.inc("sbit_github_errors_total", {"method": method})
+        raise
+    finally:
+        metrics.observe("sbit_github_request_seconds", time.monotonic() - start, {"method": method})
+    metrics.inc("sbit_github_requests_total", {"method": method, "status": response.status_code})
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    if remaining is not None:
+        metrics.set("sbit_github_ratelimit_remaining", int(remaining))
+    return response
+
+class InstrumentedRequest(HTTPXRequest):
+    """Richieste verso la Bot API di Telegram con latenza ed errori registrati per metodo."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.monotonic()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc("sbit_telegram_errors_total", {"method": api_method})
+            raise
+        finally:
+            metrics.observe("sbit_telegram_request_seconds", time.monotonic() - start, {"method": api_method})
+        metrics.inc("sbit_telegram_requests_total", {"method": api_method, "status": code})
+        return code, payload
+
+def instrumented(command, callback):
+    """Avvolge un handler misurandone la durata e contando gli errori."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.monotonic()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("sbit_handler_errors_total", {"command": command})
+            raise
+        finally:
+            metrics.observe("sbit_handler_seconds", time.monotonic() - start, {"command": command})
+    return wrapper
+
+def throttled(command, cooldown, callback):
+    """Scarta senza risposta i comandi di un utente arrivati meno di cooldown secondi dopo il precedente.
+    Va applicato fuori da serialized(), così lo spam non resta in coda dietro il lock dell'utente."""
+    last_accepted = OrderedDict()  # user_id -> ultimo comando accettato, dal più vecchio al più recente
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = update.effective_user
+        if user is not None:
+            now = time.monotonic()
+            if now - last_accepted.get(user.id, -cooldown) < cooldown:
+                metrics.inc("sbit_commands_dropped_total", {"command": command})
+                return
+            last_accepted[user.id] = now
+            last_accepted.move_to_end(user.id)
+            # Le voci più vecchie del cooldown non servono più: la mappa resta grande quanto gli utenti attivi
+            while last_accepted:
+                user_id, accepted = next(iter(last_accepted.items()))
+                if now - accepted < cooldown:
+                    break
+                del last_accepted[user_id]
+        return await callback(update, context)
+    return wrapper
+
+class UserLocks:
+    """Lock asyncio per utente, creati al primo uso ed eliminati quando nessuno li tiene o li aspetta."""
+
+    def __init__(self):
+        self._locks = {}  # user_id -> [lock, handler che lo tengono o lo aspettano]
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+    def __len__(self):
+        return len(self._locks)
+
+user_locks = UserLocks()
+
+def when_ready(callback):
+    """Tiene in coda gli update arrivati mentre il bot carica ancora collezioni e codici (vedi Startup),
+    così nessun handler lavora su uno stato vuoto. Va applicato fuori da serialized()."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if not startup.ready.is_set():
+            metrics.inc("sbit_updates_queued_total")
+            try:
+                await asyncio.wait_for(startup.ready.wait(), STARTUP_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                if update.effective_message is not None:
+                    await update.effective_message.reply_text("⏳ Il bot si sta ancora avviando, riprova tra qualche istante!")
+                return
+        return await callback(update, context)
+    return wrapper
+
+def serialized(callback):
+    """Esegue l'handler tenendo il lock dell'utente: gli update dello stesso utente vengono gestiti uno alla volta,
+    quelli di utenti diversi in parallelo."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = update.effective_user
+        if user is None:
+            return await callback(update, context)
+        # Ricorda il nome per la classifica, qualunque sia il comando
+        display_names.remember(user)
+        async with user_locks.hold(user.id):
+            return await callback(update, context)
+    return wrapper
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render())
+
+class TokenBucket:
+    """Token bucket a prenotazione: reserve() scala subito i token e ritorna quanto aspettare prima di usarli."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost=1):
+        self.refill()
+        self.tokens -= cost
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+class SendScheduler(BaseRateLimiter):
+    """Coda centrale di tutti gli invii verso Telegram, usata dal bot come rate limiter di PTB.
+    Ogni messaggio aspetta prima il token della propria chat, poi entra in una coda a priorità servita
+    al ritmo del limite globale: i messaggi di testo passano davanti a foto e album.
+    Un RetryAfter sospende tutti gli invii per il tempo richiesto e il messaggio viene ritentato."""
+
+    TEXT_PRIORITY = 0
+    MEDIA_PRIORITY = 1
+    BACKGROUND_PRIORITY = 2  # Messaggi non richiesti (es. notifiche): passano dopo le risposte ai comandi
+    MEDIA_ENDPOINTS = {"sendPhoto", "sendMediaGroup", "sendDocument"}
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE, group_rate=GROUP_SEND_RATE, max_retries=SEND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.paused_until = 0
+        self._queue = []
+        self._sequence = count()
+        self._wakeup = None
+        self._task = None
+
+    async def initialize(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Lascia passare chi era ancora in coda
+        for _, _, _, waiter in self._queue:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._queue.clear()
+
+    def queue_size(self):
+        return len(self._queue)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # I bucket pieni equivalgono a uno nuovo: si possono buttare
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full()}
+            # Gli ID negativi sono gruppi e canali, con un limite molto più basso
+            rate = self.group_rate if str(chat_id).startswith(("-", "@")) else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, CHAT_SEND_BURST)
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            _, _, cost, waiter = heapq.heappop(self._queue)
+            if waiter.done():  # Handler annullato mentre era in coda
+                continue
+            delay = self.global_bucket.reserve(cost)
+            if delay:
+                await asyncio.sleep(delay)
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _acquire(self, chat_id, cost, priority):
+        start = time.monotonic()
+        # Per la chat conta la richiesta (un album è un solo invio), per il limite globale ogni messaggio
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), cost, waiter))
+        self._wakeup.set()
+        await waiter
+        metrics.observe("sbit_send_wait_seconds", time.monotonic() - start, {"priority": str(priority)})
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._task is None:
+            # Chiamate non legate a una chat (getMe, setWebhook, answerCallbackQuery...) non sono limitate
+            return await callback(*args, **kwargs)
+
+        cost = len(data.get("media") or ()) or 1
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint in self.MEDIA_ENDPOINTS:
+            priority = self.MEDIA_PRIORITY
+        else:
+            priority = self.TEXT_PRIORITY
+
+        for attempt in count():
+            await self._acquire(chat_id, cost, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                metrics.inc("sbit_telegram_retry_after_total", {"method": endpoint})
+                print(f"Limite di Telegram raggiunto su {endpoint}: pausa di {e.retry_after} secondi.")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+
+send_scheduler = SendScheduler()
+
+RARITIES = list(CARD_FILES)
+RARITY_INDEX = {rarity: index for index, rarity in enumerate(RARITIES)}
+
+class CardIndex:
+    """Tabella append-only nome carta -> ordinale.
+    Le carte del catalogo ricevono gli ordinali più bassi; le carte esclusive (assegnate con i codici
+    e assenti dai file) vengono aggiunte in coda la prima volta che compaiono."""
+
+    def __init__(self):
+        self.names = []
+        self.ordinals = {}
+
+    def intern(self, name):
+        ordinal = self.ordinals.get(name)
+        if ordinal is None:
+            ordinal = len(self.names)
+            self.names.append(name)
+            self.ordinals[name] = ordinal
+        return ordinal
+
+    def name(self, ordinal):
+        return self.names[ordinal]
+
+card_index = CardIndex()
+
+# Contatore globale delle versioni: una collezione nuova (es. dopo un reset) non riusa mai una versione vecchia
+collection_versions = count(1)
+
+class Collection:
+    """Collezione di un utente in formato compatto.
+
+    Per ogni rarità tiene una bitmask degli ordinali posseduti (test di appartenenza O(1)), più
+    un unico array con gli ordinali nell'ordine di inserimento (ogni voce è ordinale << 2 | rarità),
+    così la conversione da/verso lo schema JSON (liste di nomi per rarità + pack_reserve/last_opened)
+    è senza perdite."""
+
+    __slots__ = ("masks", "order", "meta", "version")
+
+    def __init__(self):
+        self.masks = [0] * len(RARITIES)
+        self.order = array("I")
+        self.meta = {}  # Chiavi non legate alle carte (pack_reserve, last_opened, ...)
+        self.version = next(collection_versions)  # Cambia a ogni modifica delle carte
+
+    @classmethod
+    def from_json(cls, record):
+        collection = cls()
+        for key, value in record.items():
+            rarity_index = RARITY_INDEX.get(key)
+            if rarity_index is None:
+                if key != "nome":  # Vecchio nome per la classifica, ora solo in locale (DisplayNames)
+                    collection.meta[key] = value
+                continue
+            mask = collection.masks[rarity_index]
+            for card in value:
+                ordinal = card_index.intern(card)
+                mask |= 1 << ordinal
+                collection.order.append(ordinal << 2 | rarity_index)
+            collection.masks[rarity_index] = mask
+        return collection
+
+    def to_json(self):
+        record = {rarity: [] for rarity in RARITIES}
+        for entry in self.order:
+            record[RARITIES[entry & 3]].append(card_index.name(entry >> 2))
+        record.update(self.meta)
+        return record
+
+    def has(self, rarity, card):
+        ordinal = card_index.ordinals.get(card)
+        return ordinal is not None and (self.masks[RARITY_INDEX[rarity]] >> ordinal) & 1 == 1
+
+    def add(self, rarity, card):
+        """Aggiunge la carta; ritorna False se l'utente la possedeva già."""
+        rarity_index = RARITY_INDEX[rarity]
+        ordinal = card_index.intern(card)
+        bit = 1 << ordinal
+        if self.masks[rarity_index] & bit:
+            return False
+        self.masks[rarity_index] |= bit
+        self.order.append(ordinal << 2 | rarity_index)
+        self.version = next(collection_versions)
+        return True
+
+    def cards(self, rarity):
+        """Carte possedute di una rarità, nell'ordine in cui sono state ottenute."""
+        rarity_index = RARITY_INDEX[rarity]
+        return [card_index.name(entry >> 2) for entry in self.order if entry & 3 == rarity_index]
+
+    def owns_any(self, rarity):
+        return self.masks[RARITY_INDEX[rarity]] != 0
+
+    def card_count(self):
+        return len(self.order)
+
+    def is_empty(self):
+        return not self.order
+
+    @property
+    def pack_reserve(self):
+        return self.meta.get("pack_reserve")
+
+    @pack_reserve.setter
+    def pack_reserve(self, value):
+        self.meta["pack_reserve"] = value
+
+    @property
+    def last_opened(self):
+        return self.meta.get("last_opened")
+
+    @last_opened.setter
+    def last_opened(self, value):
+        self.meta["last_opened"] = value
+
+    @property
+    def notifications(self):
+        return bool(self.meta.get("notifiche"))
+
+    @notifications.setter
+    def notifications(self, value):
+        if value:
+            self.meta["notifiche"] = True
+        else:
+            self.meta.pop("notifiche", None)
+
+def collections_from_json(data):
+    return {user_id: Collection.from_json(record) for user_id, record in data.items()}
+
+def collections_to_json(collections):
+    return {user_id: collection.to_json() for user_id, collection in collections.items()}
+
+# Collezione utenti (user_id -> Collection)
 user_collections = {}
 
-# Funzione per caricare le collezioni degli utenti (se si usa un file JSON per persistere i dati)
-def load_collections():
-    global user_collections
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_FILE_PATH}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code == 200:
-        content = response.json()
-        data = b64decode(content['content']).decode('utf-8')
-        user_collections = json.loads(data)
-    else:
+class CollectionStore:
+    """Archivio SQLite locale con un record per utente: salvare un utente costa O(1),
+    indipendentemente da quanti giocatori ci sono."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS collezioni ("
+                "user_id TEXT PRIMARY KEY, dati TEXT NOT NULL, aggiornato REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS pendenti (user_id TEXT PRIMARY KEY)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids ("
+                "chiave TEXT PRIMARY KEY, hash TEXT NOT NULL, file_id TEXT NOT NULL)"
+            )
+            # Nomi visualizzati in /classifica: restano solo in locale, non finiscono nello snapshot su GitHub
+            self._conn.execute("CREATE TABLE IF NOT EXISTS nomi (user_id TEXT PRIMARY KEY, nome TEXT NOT NULL)")
+            # Stato dell'archivio (es. se è stato inizializzato da uno snapshot verificato)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stato (chiave TEXT PRIMARY KEY, valore TEXT NOT NULL)")
+            # Riscatti dei codici monouso non ancora caricati su GitHub
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS riscatti ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, lotto TEXT NOT NULL, indice INTEGER NOT NULL, "
+                "user_id TEXT NOT NULL, ora REAL NOT NULL, segmento TEXT)"
+            )
+            # Archivi creati prima della colonna segmento (caricato su GitHub, in attesa di conferma)
+            if "segmento" not in {row[1] for row in self._conn.execute("PRAGMA table_info(riscatti)")}:
+                self._conn.execute("ALTER TABLE riscatti ADD COLUMN segmento TEXT")
+        return self._conn
+
+    def load_all(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT user_id, dati FROM collezioni").fetchall()
+        return {user_id: json.loads(dati) for user_id, dati in rows}
+
+    def put(self, user_id, record):
+        """Scrive (o cancella, se record è None) la collezione di un singolo utente."""
+        with self._lock:
+            conn = self._connect()
+            if record is None:
+                conn.execute("DELETE FROM collezioni WHERE user_id = ?", (user_id,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO collezioni (user_id, dati, aggiornato) VALUES (?, ?, ?)",
+                    (user_id, json.dumps(record, separators=(",", ":")), time.time())
+                )
+
+    def put_many(self, records):
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO collezioni (user_id, dati, aggiornato) VALUES (?, ?, ?)",
+                [(user_id, json.dumps(record, separators=(",", ":")), now) for user_id, record in records.items()]
+            )
+            conn.execute("COMMIT")
+
+    def load_pending(self):
+        """Utenti modificati ma non ancora inclusi in uno snapshot su GitHub."""
+        with self._lock:
+            rows = self._connect().execute("SELECT user_id FROM pendenti").fetchall()
+        return {user_id for user_id, in rows}
+
+    def add_pending(self, user_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR IGNORE INTO pendenti (user_id) VALUES (?)", [(user_id,) for user_id in user_ids])
+            conn.execute("COMMIT")
+
+    def remove_pending(self, user_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM pendenti WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+            conn.execute("COMMIT")
+
+    def load_file_ids(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT chiave, hash, file_id FROM file_ids").fetchall()
+        return {chiave: (digest, file_id) for chiave, digest, file_id in rows}
+
+    def put_file_id(self, key, digest, file_id):
+        with self._lock:
+            conn = self._connect()
+            if file_id is None:
+                conn.execute("DELETE FROM file_ids WHERE chiave = ?", (key,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO file_ids (chiave, hash, file_id) VALUES (?, ?, ?)",
+                    (key, digest, file_id)
+                )
+
+    def load_names(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT user_id, nome FROM nomi").fetchall()
+        return dict(rows)
+
+    def put_name(self, user_id, name):
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO nomi (user_id, nome) VALUES (?, ?)", (user_id, name))
+
+    def get_state(self, key):
+        with self._lock:
+            row = self._connect().execute("SELECT valore FROM stato WHERE chiave = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO stato (chiave, valore) VALUES (?, ?)", (key, value))
+
+    def add_redemption(self, batch_id, index, user_id, timestamp):
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO riscatti (lotto, indice, user_id, ora) VALUES (?, ?, ?, ?)",
+                (batch_id, index, user_id, timestamp)
+            )
+        return cursor.lastrowid
+
+    def load_redemptions(self):
+        """Riscatti non ancora confermati dal log su GitHub: lista di (id, lotto, indice, user_id, ora, segmento),
+        con segmento None se non sono ancora stati caricati."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, lotto, indice, user_id, ora, segmento FROM riscatti ORDER BY id"
+            ).fetchall()
+
+    def mark_redemptions_uploaded(self, row_ids, segment):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany("UPDATE riscatti SET segmento = ? WHERE id = ?", [(segment, row_id) for row_id in row_ids])
+            conn.execute("COMMIT")
+
+    def remove_redemptions(self, row_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM riscatti WHERE id = ?", [(row_id,) for row_id in row_ids])
+            conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+store = CollectionStore(DB_PATH)
+
+def shard_index(user_id):
+    """Shard dello snapshot a cui appartiene l'utente (hash stabile tra un avvio e l'altro)."""
+    return zlib.crc32(user_id.encode("utf-8")) % SNAPSHOT_SHARDS
+
+def shard_path(index):
+    return f"{GITHUB_SNAPSHOT_DIR}/shard-{index:03d}.json.gz"
+
+SHARD_NAME_PATTERN = re.compile(r"^shard-(\d+)\.json\.gz$")
+
+def encode_shard(records):
+    """Shard compresso: JSON compatto + gzip (mtime fisso, così lo stesso contenuto dà gli stessi byte)."""
+    return gzip.compress(json.dumps(records, separators=(",", ":")).encode("utf-8"), mtime=0)
+
+def decode_shard(data):
+    return json.loads(gzip.decompress(data).decode("utf-8"))
+
+def github_headers(accept="application/vnd.github.v3+json"):
+    return {"Authorization": f"token {GITHUB_TOKEN}", "Accept": accept}
+
+class ChecksumError(RuntimeError):
+    """Il contenuto scaricato non corrisponde allo sha dichiarato da GitHub."""
+
+def git_blob_sha(data):
+    """Sha con cui git (e quindi l'API contents) identifica il contenuto di un file."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def verify_blob(path, data, expected_sha):
+    if expected_sha is not None and git_blob_sha(data) != expected_sha:
+        raise ChecksumError(f"Checksum non valido per {path}: atteso {expected_sha}, ricevuto {git_blob_sha(data)}")
+    return data
+
+def list_github_dir(path):
+    """Elenca una cartella del repository. Ritorna {nome: sha}, o None se la cartella non esiste."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{path}"
+    response = github_request("GET", url, headers=github_headers())
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"Errore nell'elenco di {path} ({response.status_code}): {response.text}")
+    return {entry["name"]: entry["sha"] for entry in response.json()}
+
+def fetch_github_raw(path, expected_sha=None):
+    """Scarica un file del repository in formato raw. Ritorna None se non esiste.
+    Se expected_sha è indicato (dall'elenco della cartella), il contenuto viene verificato."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{path}"
+    response = github_request("GET", url, headers=github_headers("application/vnd.github.raw"))
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"Errore nel caricamento di {path} ({response.status_code})")
+    return verify_blob(path, response.content, expected_sha)
+
+def create_github_file(path, data, message):
+    """Crea un nuovo file (bytes) nel repository. Ritorna lo sha, o None se il file esiste già o in caso di errore."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{path}"
+    payload = {"message": message, "content": b64encode(data).decode("utf-8")}
+    response = github_request("PUT", url, headers=github_headers(), json=payload)
+    if response.status_code in (200, 201):
+        return response.json()["content"]["sha"]
+    print(f"Errore nella creazione di {path} ({response.status_code}): {response.text}")
+    return None
+
+def delete_github_file(path, sha, message):
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{path}"
+    response = github_request("DELETE", url, headers=github_headers(), json={"message": message, "sha": sha})
+    return response.status_code == 200
+
+def list_snapshot_shards():
+    """Elenca gli shard su GitHub con una sola richiesta. Ritorna {indice: sha}, o None se la cartella non esiste."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{GITHUB_SNAPSHOT_DIR}"
+    response = github_request("GET", url, headers=github_headers())
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"Errore nell'elenco degli shard ({response.status_code}): {response.text}")
+    shards = {}
+    for entry in response.json():
+        match = SHARD_NAME_PATTERN.match(entry["name"])
+        if match:
+            shards[int(match.group(1))] = entry["sha"]
+    return shards
+
+def fetch_shard(index, expected_sha=None):
+    """Scarica uno shard in formato raw: niente base64 e nessun limite di 1 MB dell'API contents.
+    Con expected_sha il contenuto viene verificato (ChecksumError se non corrisponde)."""
+    data = fetch_github_raw(shard_path(index), expected_sha)
+    if data is None:
+        return {}
+    return decode_shard(data)
+
+def fetch_verified_shard(index, sha):
+    """Scarica uno shard verificandone lo sha. Se non corrisponde (es. lo shard è appena stato riscritto
+    da un'altra istanza) rilegge l'elenco e riprova. Ritorna (record, sha verificato)."""
+    for attempt in range(3):
+        try:
+            return fetch_shard(index, sha), sha
+        except ChecksumError as e:
+            print(f"{e} (tentativo {attempt + 1})")
+            sha = (list_snapshot_shards() or {}).get(index)
+            if sha is None:
+                return {}, None
+    raise ChecksumError(f"Impossibile scaricare una copia verificata dello shard {index}")
+
+def fetch_legacy_snapshot():
+    """Scarica il vecchio snapshot in un unico file, verificandone lo sha. Ritorna None se non esiste."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{GITHUB_FILE_PATH}"
+    response = github_request("GET", url, headers=github_headers())
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"Errore nel caricamento dello snapshot ({response.status_code}): {response.text}")
+    content = response.json()
+    data = verify_blob(GITHUB_FILE_PATH, b64decode(content["content"]), content["sha"])
+    return json.loads(data.decode("utf-8"))
+
+def fetch_collections_snapshot():
+    """Scarica lo snapshot delle collezioni da GitHub (bloccante), con gli shard letti in parallelo.
+    Ritorna (collezioni in formato JSON, {indice shard: sha}, legacy); legacy è True se è stato letto
+    il vecchio file unico, e va quindi migrato agli shard. Ritorna (None, {}, False) se non esiste nulla."""
+    shards = list_snapshot_shards()
+    if shards is None:
+        legacy = fetch_legacy_snapshot()
+        return legacy, {}, legacy is not None
+
+    snapshot = {}
+    verified = {}
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        indexes = sorted(shards)
+        for index, (records, sha) in zip(indexes, pool.map(fetch_verified_shard, indexes, [shards[i] for i in indexes])):
+            snapshot.update(records)
+            if sha is not None:
+                verified[index] = sha
+    return snapshot, verified, False
+
+# Funzione per caricare le collezioni degli utenti: dall'archivio locale se è già stato inizializzato
+# da uno snapshot verificato, altrimenti dallo snapshot su GitHub (bloccante)
+def fetch_collections_state():
+    """Legge le collezioni senza toccare lo stato globale: ritorna (record per utente, sha degli shard,
+    utenti da sincronizzare), da applicare nell'event loop con apply_collections_state.
+    Solleva un'eccezione se lo snapshot non può essere scaricato o verificato: in quel caso il bot
+    non deve partire con collezioni vuote, altrimenti il primo salvataggio cancellerebbe le carte di tutti."""
+    if store.get_state("snapshot_verificato"):
+        records = store.load_all()
+        # Le modifiche non ancora finite nello snapshot prima dello spegnimento restano da sincronizzare
+        pending = store.load_pending()
+        shas = {int(index): sha for index, sha in json.loads(store.get_state("sha_shard") or "{}").items()}
+        refreshed = refresh_stale_shards(records, shas, pending)
+        print(f"Caricate {len(records)} collezioni dall'archivio locale ({len(pending)} da sincronizzare, "
+              f"{refreshed} shard aggiornati da GitHub).")
+        return records, shas, pending
+
+    snapshot, shas, legacy = fetch_collections_snapshot()
+    if snapshot is None:
         print("Nessuna collezione trovata su GitHub. Creazione nuova...")
-        
-def load_codes_from_github():
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_CODES_FILE_PATH}"
+        snapshot = {}
+
+    # Archivio locale scritto senza uno snapshot verificato (es. da una versione precedente del bot):
+    # le modifiche in sospeso sono più recenti dello snapshot e vincono
+    pending = store.load_pending()
+    local_changes = len(pending)
+    if pending:
+        local = store.load_all()
+        for user_id in pending:
+            if user_id in local:
+                snapshot[user_id] = local[user_id]
+            else:
+                snapshot.pop(user_id, None)
+
+    # Importa lo snapshot nell'archivio locale
+    store.put_many(snapshot)
+    if legacy:
+        # Migrazione: al primo flush tutti gli utenti finiscono negli shard
+        store.add_pending(snapshot)
+        pending |= set(snapshot)
+    store.set_state("sha_shard", json.dumps(shas))
+    store.set_state("snapshot_verificato", datetime.now().isoformat())
+    print(f"Caricate {len(snapshot)} collezioni dallo snapshot su GitHub"
+          f"{' (vecchio formato, verrà migrato agli shard)' if legacy else ''}"
+          f"{f', {local_changes} modifiche locali mantenute' if local_changes else ''}.")
+    return snapshot, shas, pending
+
+def refresh_stale_shards(records, shas, pending):
+    """Riavvio dall'archivio locale: con un solo elenco degli shard riscarica quelli modificati su GitHub
+    (da un altro worker o da un'istanza sovrapposta) e aggiorna records, shas e l'archivio.
+    Ritorna il numero di shard riscaricati."""
+    remote_shas = list_snapshot_shards() or {}
+    stale = sorted(index for index, sha in remote_shas.items() if shas.get(index) != sha)
+    for index in set(shas) - set(remote_shas):
+        del shas[index]
+    if not stale:
+        store.set_state("sha_shard", json.dumps(shas))
+        return 0
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        fetched = list(pool.map(fetch_verified_shard, stale, [remote_shas[index] for index in stale]))
+    stale_set = set(stale)
+    local_users = {}
+    for user_id in records:
+        index = shard_index(user_id)
+        if index in stale_set:
+            local_users.setdefault(index, set()).add(user_id)
+    changed = {}
+    for index, (remote, sha) in zip(stale, fetched):
+        for user_id, record in remote.items():
+            if user_id in pending and user_id in records:
+                record = merge_collection_records(records[user_id], record)
+            elif user_id in pending:
+                continue  # Cancellato qui e non ancora sincronizzato
+            if records.get(user_id) != record:
+                records[user_id] = changed[user_id] = record
+        # Utenti non più presenti nello shard remoto e senza modifiche locali
+        for user_id in local_users.get(index, set()) - set(remote) - pending:
+            del records[user_id]
+            changed[user_id] = None
+        if sha is None:
+            shas.pop(index, None)
+        else:
+            shas[index] = sha
+    store.put_many({user_id: record for user_id, record in changed.items() if record is not None})
+    for user_id in [user_id for user_id, record in changed.items() if record is None]:
+        store.put(user_id, None)
+    store.set_state("sha_shard", json.dumps(shas))
+    return len(stale)
+
+def apply_collections_state(records, shas, pending):
+    """Adotta le collezioni lette da fetch_collections_state (nell'event loop, come ogni altra modifica)."""
+    global user_collections
+    user_collections = collections_from_json(records)
+    save_queue.rebuild_members(user_collections)
+    save_queue.shas = shas
+    save_queue.dirty |= pending
+    collection_stats.rebuild(user_collections)
+
+def load_collections():
+    apply_collections_state(*fetch_collections_state())
+
+def fetch_codes_from_github(etag=None):
+    """Scarica codes.json con una richiesta condizionale.
+    Ritorna (codici, sha, etag); codici è None se il file non è cambiato (304).
+    Solo un 404 significa "nessun codice": ogni altro errore solleva un'eccezione, così un problema
+    temporaneo di GitHub non cancella i codici già in memoria."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{GITHUB_CODES_FILE_PATH}"
     headers = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
-    response = requests.get(url, headers=headers)
+    if etag:
+        headers["If-None-Match"] = etag
+    response = github_request("GET", url, headers=headers)
+    if response.status_code == 304:
+        return None, None, etag
     if response.status_code == 200:
         content = response.json()
-        return json.loads(b64decode(content['content']).decode('utf-8'))
-    return {"valid_codes": {}, "used_codes": []}
-
-def save_codes_to_github(codes):
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_CODES_FILE_PATH}"
+        data = verify_blob(GITHUB_CODES_FILE_PATH, b64decode(content['content']), content['sha'])
+        codes = json.loads(data.decode('utf-8'))
+        return codes, content['sha'], response.headers.get("ETag")
+    if response.status_code == 404:
+        return {"valid_codes": {}, "used_codes": {}}, None, None
+    raise RuntimeError(f"Errore nel caricamento dei codici ({response.status_code}): {response.text}")
+
+def save_codes_to_github(data, sha):
+    """Scrive codes.json usando lo sha già noto. Ritorna il nuovo sha, o None in caso di conflitto/errore."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{GITHUB_CODES_FILE_PATH}"
     headers = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
-    response = requests.get(url, headers=headers)
-    sha = response.json().get('sha', None)
-    encoded_data = b64encode(json.dumps(codes, indent=4).encode('utf-8')).decode('utf-8')
-    payload = {"message": "Aggiornamento codici", "content": encoded_data, "sha": sha}
-    requests.put(url, headers=headers, json=payload)
+    encoded_data = b64encode(data.encode('utf-8')).decode('utf-8')
+    payload = {"message": "Aggiornamento codici", "content": encoded_data}
+    if sha:
+        payload["sha"] = sha
+    response = github_request("PUT", url, headers=headers, json=payload)
+    if response.status_code in (200, 201):
+        return response.json()["content"]["sha"]
+    print(f"Errore nel salvataggio dei codici ({response.status_code}): {response.text}")
+    return None
+
+# Intervallo minimo (in secondi) tra due controlli di codes.json su GitHub
+CODES_REFRESH_INTERVAL = int(os.environ.get("CODES_REFRESH_INTERVAL", 60))
+
+# Attesa (in secondi) prima di riscrivere codes.json dopo un riscatto: i riscatti arrivati nel frattempo
+# finiscono nella stessa scrittura
+CODES_SAVE_DELAY = int(os.environ.get("CODES_SAVE_DELAY", 10))
+
+class CodesIndex:
+    """Indice in memoria di codes.json.
+
+    Il file viene ricontrollato al massimo ogni CODES_REFRESH_INTERVAL secondi con
+    If-None-Match (le risposte 304 non consumano il rate limit di GitHub), e i riscatti
+    sono indicizzati per codice, così il controllo "già riscattato" è O(1)."""
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.codes = {"valid_codes": {}, "used_codes": {}}
+        self.redeemed = {}  # codice -> set di user_id
+        self.sha = None
+        self.etag = None
+        self.last_refresh = None
+        self.lock = asyncio.Lock()
+        self._refresh_lock = asyncio.Lock()
+        self._dirty = False
+        self._save_task = None
+
+    def _apply(self, remote):
+        """Adotta i codici validi remoti e unisce i riscatti: un riscatto non viene mai perso."""
+        used_codes = remote.get("used_codes") or {}
+        if not isinstance(used_codes, dict):
+            used_codes = {}
+        for user_id, codes in self.codes["used_codes"].items():
+            remote_codes = used_codes.setdefault(user_id, [])
+            remote_codes.extend(code for code in codes if code not in remote_codes)
+        self.codes = {"valid_codes": remote.get("valid_codes", {}), "used_codes": used_codes}
+        self.redeemed = {}
+        for user_id, codes in used_codes.items():
+            for code in codes:
+                self.redeemed.setdefault(code, set()).add(user_id)
+
+    async def refresh(self, force=False):
+        """Ricontrolla codes.json. Se il download fallisce solleva l'eccezione e lascia invariati
+        codici, sha ed etag in memoria."""
+        async with self._refresh_lock:
+            now = time.monotonic()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            codes, sha, etag = await asyncio.to_thread(fetch_codes_from_github, None if force else self.etag)
+            self.last_refresh = time.monotonic()
+            if codes is None:
+                return
+            self._apply(codes)
+            self.sha = sha
+            self.etag = etag
+
+    def is_valid(self, code):
+        return code in self.codes["valid_codes"]
+
+    def reward(self, code):
+        return self.codes["valid_codes"][code]
+
+    def is_redeemed(self, code, user_id):
+        return user_id in self.redeemed.get(code, ())
+
+    def mark_redeemed(self, code, user_id):
+        self.codes["used_codes"].setdefault(user_id, []).append(code)
+        self.redeemed.setdefault(code, set()).add(user_id)
+        self._dirty = True
+
+    def schedule_save(self):
+        """Avvia il salvataggio in background dopo CODES_SAVE_DELAY secondi: i riscatti arrivati nel frattempo
+        (es. durante una promozione) finiscono in un'unica scrittura di codes.json."""
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.get_running_loop().create_task(self._save_later())
+
+    async def _save_later(self):
+        # Continua finché restano riscatti: anche quelli arrivati durante un salvataggio o dopo un errore
+        while self._dirty:
+            await asyncio.sleep(max(CODES_SAVE_DELAY, 1))
+            await self.save()
+
+    async def save(self):
+        """Scrive codes.json una volta (più i tentativi dopo un conflitto)."""
+        attempts = 0
+        while self._dirty and attempts < 3:
+            self._dirty = False
+            data = json.dumps(self.codes, indent=4)
+            try:
+                sha = await asyncio.to_thread(save_codes_to_github, data, self.sha)
+            except Exception as e:
+                print(f"Errore nel salvataggio dei codici: {e}")
+                sha = None
+            if sha:
+                self.sha = sha
+                # I riscatti arrivati durante la scrittura aspettano il prossimo giro di _save_later
+                return
+            # Conflitto (sha non aggiornato): riscarica, unisci i riscatti e riprova
+            self._dirty = True
+            attempts += 1
+            try:
+                await self.refresh(force=True)
+            except Exception as e:
+                print(f"Errore nell'aggiornamento dei codici: {e}")
+        if self._dirty:
+            print("Salvataggio dei codici non riuscito, verrà ritentato.")
+
+    async def stop(self):
+        """Interrompe l'attesa del salvataggio e scrive gli ultimi riscatti."""
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+        if self._dirty:
+            await self.save()
+
+codes_index = CodesIndex(CODES_REFRESH_INTERVAL)
+
+# Codici monouso: alfabeto senza caratteri ambigui (0/O, 1/I), 32 simboli -> 5 bit per carattere
+CODE_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+CODE_LENGTH = 12
+CODE_DIGEST_SIZE = 16
+MAX_CODES_PER_BATCH = 100000
+
+# Attesa (in secondi) prima di caricare su GitHub un nuovo segmento del log dei riscatti:
+# i riscatti arrivati nel frattempo finiscono nello stesso segmento
+REDEMPTION_FLUSH_DELAY = int(os.environ.get("REDEMPTION_FLUSH_DELAY", 30))
+
+# Oltre questo numero di segmenti il bot li compatta da solo (l'API contents ne elenca al massimo 1000)
+REDEMPTION_COMPACT_THRESHOLD = int(os.environ.get("REDEMPTION_COMPACT_THRESHOLD", 100))
+
+REDEMPTION_SEGMENT_PATTERN = re.compile(r"^\d+-[0-9a-f]+\.log$")
+
+def normalize_code(code):
+    """I codici monouso si possono scrivere in minuscolo e con trattini o spazi: XXXX-XXXX-XXXX."""
+    return re.sub(r"[\s-]", "", code).upper()
+
+def format_code(code):
+    return "-".join(code[i:i + 4] for i in range(0, len(code), 4))
+
+class CodeBatch:
+    """Lotto di codici monouso con lo stesso premio. Per ogni codice si tiene solo lo stato dei riscatti:
+    un bit se il codice è usabile una volta sola, altrimenti un contatore e gli utenti che l'hanno usato."""
+
+    __slots__ = ("batch_id", "reward", "max_uses", "size", "created", "redeemed", "uses", "users")
+
+    def __init__(self, batch_id, reward, max_uses, size, created):
+        self.batch_id = batch_id
+        self.reward = reward
+        self.max_uses = max_uses
+        self.size = size
+        self.created = created
+        if max_uses == 1:
+            self.redeemed = bytearray((size + 7) // 8)
+            self.uses = None
+        else:
+            self.redeemed = None
+            self.uses = array("H", bytes(2 * size))
+        self.users = {}  # indice -> set di user_id (solo per i codici a più usi)
+
+    def used(self, index):
+        if self.uses is None:
+            return (self.redeemed[index >> 3] >> (index & 7)) & 1
+        return self.uses[index]
+
+    def used_by(self, index, user_id):
+        if self.uses is None:
+            return False  # Un codice a uso singolo, se riscattato, è comunque esaurito
+        return user_id in self.users.get(index, ())
+
+    def apply(self, index, user_id):
+        """Registra un riscatto. È idempotente, così il log si può rileggere più volte senza contare doppio."""
+        if self.uses is None:
+            if self.used(index):
+                return False
+            self.redeemed[index >> 3] |= 1 << (index & 7)
+            return True
+        users = self.users.setdefault(index, set())
+        if user_id in users or self.uses[index] >= self.max_uses:
+            return False
+        users.add(user_id)
+        self.uses[index] += 1
+        return True
+
+    def redeemed_count(self):
+        if self.uses is None:
+            return sum(bin(byte).count("1") for byte in self.redeemed)
+        return sum(self.uses)
+
+    def encode(self, digests):
+        """File del lotto su GitHub: JSON compresso con gli hash dei codici concatenati in base64."""
+        return gzip.compress(json.dumps({
+            "id": self.batch_id,
+            "reward": self.reward,
+            "max_uses": self.max_uses,
+            "created": self.created,
+            "hashes": b64encode(b"".join(digests)).decode("ascii"),
+        }, separators=(",", ":")).encode("utf-8"), mtime=0)
+
+    @classmethod
+    def decode(cls, data):
+        record = json.loads(gzip.decompress(data).decode("utf-8"))
+        packed = b64decode(record["hashes"])
+        digests = [packed[i:i + CODE_DIGEST_SIZE] for i in range(0, len(packed), CODE_DIGEST_SIZE)]
+        return cls(record["id"], record["reward"], record["max_uses"], len(digests), record["created"]), digests
+
+def batch_path(batch_id):
+    return f"{GITHUB_CODE_BATCHES_DIR}/{batch_id}.json.gz"
+
+class OneTimeCodes:
+    """Codici monouso o a usi limitati, generati a lotti da decine di migliaia.
+
+    In memoria c'è solo un dizionario hash del codice -> (lotto, posizione): il riscatto è O(1)
+    e i codici in chiaro non vengono salvati da nessuna parte. Ogni riscatto viene scritto subito
+    nell'archivio locale e poi caricato su GitHub come nuovo segmento del log dei riscatti,
+    senza mai riscrivere i file esistenti."""
+
+    def __init__(self, secret, refresh_interval):
+        self.secret = secret.encode("utf-8")
+        self.refresh_interval = refresh_interval
+        self.batches = []  # Lotti in ordine di caricamento
+        self.batch_ids = {}  # id lotto -> posizione in batches
+        self.index = {}  # hash del codice -> posizione del lotto << 20 | posizione del codice
+        self.pending = []  # Riscatti non ancora su GitHub: (id riga, lotto, indice, user_id, ora)
+        self.unconfirmed = {}  # Riscatti caricati ma non ancora visti nel log: (lotto, indice, user_id) -> id riga
+        self.segments = set()  # Segmenti del log dei riscatti già applicati (nostri o di altre istanze)
+        self.last_refresh = None
+        self._refresh_lock = asyncio.Lock()
+        self._compact_task = None
+        self._save_task = None
+
+    def require_secret(self):
+        if not self.secret:
+            raise ValueError("CODES_SECRET non configurato: i codici monouso sono disattivati.")
+
+    def digest(self, code):
+        return hashlib.blake2b(normalize_code(code).encode("utf-8"), digest_size=CODE_DIGEST_SIZE, key=self.secret).digest()
+
+    def add_batch(self, batch, digests):
+        if batch.batch_id in self.batch_ids:
+            return
+        position = len(self.batches)
+        self.batches.append(batch)
+        self.batch_ids[batch.batch_id] = position
+        for index, digest in enumerate(digests):
+            self.index[digest] = position << 20 | index
+
+    def lookup(self, code):
+        """Ritorna (lotto, posizione del codice), o None se il codice non esiste."""
+        entry = self.index.get(self.digest(code))
+        if entry is None:
+            return None
+        return self.batches[entry >> 20], entry & 0xFFFFF
+
+    def replay(self, batch_id, index, user_id):
+        position = self.batch_ids.get(batch_id)
+        if position is not None and 0 <= index < self.batches[position].size:
+            self.batches[position].apply(index, user_id)
+
+    def redeem(self, code, user_id):
+        """Prova a riscattare il codice. Ritorna (esito, premio) con esito tra
+        "non_valido", "già_riscattato", "esaurito" e "ok"."""
+        found = self.lookup(code)
+        if found is None:
+            return "non_valido", None
+        batch, index = found
+        if batch.used_by(index, user_id):
+            return "già_riscattato", None
+        if not batch.apply(index, user_id):
+            return "esaurito", None
+        timestamp = time.time()
+        row_id = store.add_redemption(batch.batch_id, index, user_id, timestamp)
+        self.pending.append((row_id, batch.batch_id, index, user_id, timestamp))
+        return "ok", batch.reward
+
+    def mint(self, count, reward, max_uses=1):
+        """Genera un nuovo lotto (solo in memoria). Ritorna (lotto, codici in chiaro, hash)."""
+        self.require_secret()
+        if not 1 <= count <= MAX_CODES_PER_BATCH:
+            raise ValueError(f"Si possono generare da 1 a {MAX_CODES_PER_BATCH} codici per lotto.")
+        if not 1 <= max_uses <= 0xFFFF:
+            raise ValueError("Il numero di usi per codice deve essere tra 1 e 65535.")
+        validate_reward(reward)
+        batch_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        codes, digests, seen = [], [], set()
+        while len(codes) < count:
+            # 256 è multiplo di 32: il modulo non introduce sbilanciamenti
+            code = "".join(CODE_ALPHABET[byte % len(CODE_ALPHABET)] for byte in secrets.token_bytes(CODE_LENGTH))
+            digest = self.digest(code)
+            if digest in seen or digest in self.index:
+                continue
+            seen.add(digest)
+            codes.append(format_code(code))
+            digests.append(digest)
+        batch = CodeBatch(batch_id, reward, max_uses, count, datetime.now().isoformat())
+        return batch, codes, digests
+
+    def publish(self, batch, digests):
+        """Carica il lotto su GitHub (bloccante) e lo rende riscattabile. Ritorna True se riuscito."""
+        self.require_secret()
+        sha = create_github_file(batch_path(batch.batch_id), batch.encode(digests), f"Nuovo lotto di codici {batch.batch_id}")
+        if sha is None:
+            return False
+        self.add_batch(batch, digests)
+        return True
+
+    def fetch_batches(self):
+        """Scarica i lotti non ancora in memoria (bloccante). Ritorna quanti ne sono stati aggiunti."""
+        if not self.secret:
+            return 0
+        listing = list_github_dir(GITHUB_CODE_BATCHES_DIR) or {}
+        missing = [name[:-len(".json.gz")] for name in listing if name.endswith(".json.gz")]
+        missing = [batch_id for batch_id in sorted(missing) if batch_id not in self.batch_ids]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            paths = list(map(batch_path, missing))
+            shas = [listing[path.rsplit("/", 1)[1]] for path in paths]
+            for data in pool.map(fetch_github_raw, paths, shas):
+                if data is not None:
+                    self.add_batch(*CodeBatch.decode(data))
+        return len(missing)
+
+    def fetch_redemptions(self):
+        """Scarica i segmenti del log dei riscatti non ancora applicati (bloccante).
+        Ritorna (nomi di tutti i segmenti, [(nome, riscatti)] dei nuovi): vanno applicati con apply_segments."""
+        listing = list_github_dir(GITHUB_REDEMPTIONS_DIR) or {}
+        names = {name for name in listing if REDEMPTION_SEGMENT_PATTERN.match(name)}
+        segments = sorted(names - self.segments)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            paths = [f"{GITHUB_REDEMPTIONS_DIR}/{name}" for name in segments]
+            data = pool.map(fetch_github_raw, paths, [listing[name] for name in segments])
+            return names, [(name, list(parse_redemption_log(content or b""))) for name, content in zip(segments, data)]
+
+    def apply_segments(self, names, segments):
+        """Applica i riscatti scaricati. replay è idempotente: i segmenti compattati o già visti non contano doppio.
+        I riscatti locali già caricati vengono cancellati dall'archivio solo quando compaiono in un segmento letto."""
+        confirmed = []
+        for name, entries in segments:
+            for batch_id, index, user_id, _ in entries:
+                self.replay(batch_id, index, user_id)
+                row_id = self.unconfirmed.pop((batch_id, index, user_id), None)
+                if row_id is not None:
+                    confirmed.append(row_id)
+            self.segments.add(name)
+        # I segmenti cancellati da una compattazione non servono più
+        self.segments &= names
+        if confirmed:
+            store.remove_redemptions(confirmed)
+
+    def load(self):
+        """Carica lotti e log dei riscatti da GitHub, più i riscatti locali non ancora confermati (bloccante)."""
+        if not self.secret:
+            print("CODES_SECRET non configurato: codici monouso disattivati.")
+            return
+        self.fetch_batches()
+        self.pending, self.unconfirmed = [], {}
+        rows = store.load_redemptions()
+        for row_id, batch_id, index, user_id, timestamp, segment in rows:
+            if segment is None:
+                self.pending.append((row_id, batch_id, index, user_id, timestamp))
+            else:
+                self.unconfirmed[(batch_id, index, user_id)] = row_id
+        names, segments = self.fetch_redemptions()
+        self.apply_segments(names, segments)
+        # I riscatti locali valgono anche se il loro segmento non è (ancora) visibile su GitHub
+        for _, batch_id, index, user_id, _, _ in rows:
+            self.replay(batch_id, index, user_id)
+        self.last_refresh = time.monotonic()
+        print(f"Caricati {len(self.batches)} lotti di codici monouso ({len(self.index)} codici, "
+              f"{len(names)} segmenti di riscatti, {len(self.pending)} riscatti da caricare).")
+
+    async def refresh(self):
+        """Cerca nuovi lotti (es. generati dalla riga di comando) e applica i riscatti delle altre istanze,
+        al massimo ogni refresh_interval secondi: con più worker un codice a uso singolo riscattato
+        altrove viene visto entro quell'intervallo."""
+        if not self.secret:
+            return
+        async with self._refresh_lock:
+            now = time.monotonic()
+            if self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+            try:
+                await asyncio.to_thread(self.fetch_batches)
+                names, segments = await asyncio.to_thread(self.fetch_redemptions)
+            except Exception as e:
+                print(f"Errore nell'aggiornamento dei codici monouso: {e}")
+                return
+            # Applicati nell'event loop, così non cambiano mentre un riscatto è in corso
+            self.apply_segments(names, segments)
+            if len(names) > REDEMPTION_COMPACT_THRESHOLD and (self._compact_task is None or self._compact_task.done()):
+                self._compact_task = asyncio.get_running_loop().create_task(self._compact())
+
+    async def _compact(self):
+        try:
+            result = await asyncio.to_thread(compact_redemption_segments)
+        except Exception as e:
+            print(f"Errore nella compattazione dei riscatti: {e}")
+            return
+        if result:
+            print(f"{result[0]} segmenti ({result[1]} riscatti) compattati in {result[2]}")
+
+    def schedule_save(self):
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.get_running_loop().create_task(self._save_later())
+
+    async def _save_later(self):
+        # Continua finché restano riscatti: anche quelli arrivati durante un caricamento o dopo un errore
+        while self.pending:
+            await asyncio.sleep(max(REDEMPTION_FLUSH_DELAY, 1))
+            await self.save()
+
+    async def save(self):
+        """Carica i riscatti in sospeso come un nuovo segmento del log."""
+        rows = list(self.pending)
+        if not rows:
+            return
+        name = redemption_segment_name()
+        try:
+            sha = await asyncio.to_thread(
+                create_github_file, f"{GITHUB_REDEMPTIONS_DIR}/{name}", format_redemption_log(row[1:] for row in rows),
+                f"Riscatti codici ({len(rows)})"
+            )
+        except Exception as e:
+            print(f"Errore nel salvataggio dei riscatti: {e}")
+            sha = None
+        if sha is None:
+            print("Salvataggio dei riscatti non riuscito, verrà ritentato.")
+            return
+        # Le righe restano nell'archivio finché il segmento non compare in un elenco: se dopo un riavvio
+        # l'elenco non lo mostrasse ancora, i codici a uso singolo non tornerebbero riscattabili
+        saved = {row[0] for row in rows}
+        self.pending = [row for row in self.pending if row[0] not in saved]
+        for row_id, batch_id, index, user_id, _ in rows:
+            self.unconfirmed[(batch_id, index, user_id)] = row_id
+        await asyncio.to_thread(store.mark_redemptions_uploaded, saved, name)
+
+    async def stop(self):
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+        await self.save()
+
+def redemption_segment_name():
+    # I nomi si ordinano per data di creazione
+    return f"{time.time_ns()}-{secrets.token_hex(3)}.log"
+
+def compact_redemption_segments():
+    """Unisce tutti i segmenti del log dei riscatti in uno solo e cancella quelli vecchi (bloccante).
+    Ritorna (segmenti compattati, riscatti, nome del nuovo segmento), o None se non c'era niente da fare.
+    È sicuro anche con più istanze insieme: il nuovo segmento viene scritto prima di cancellare i vecchi
+    e il log si rilegge in modo idempotente."""
+    listing = list_github_dir(GITHUB_REDEMPTIONS_DIR) or {}
+    segments = {name: sha for name, sha in listing.items() if REDEMPTION_SEGMENT_PATTERN.match(name)}
+    if len(segments) < 2:
+        return None
+    entries = {}
+    names = sorted(segments)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        paths = [f"{GITHUB_REDEMPTIONS_DIR}/{name}" for name in names]
+        for data in pool.map(fetch_github_raw, paths, [segments[name] for name in names]):
+            for batch_id, index, user_id, timestamp in parse_redemption_log(data or b""):
+                entries.setdefault((batch_id, index, user_id), timestamp)
+    name = redemption_segment_name()
+    log = format_redemption_log((*key, timestamp) for key, timestamp in entries.items())
+    if create_github_file(f"{GITHUB_REDEMPTIONS_DIR}/{name}", log, f"Compattazione riscatti ({len(segments)} segmenti)") is None:
+        raise RuntimeError("Errore nella scrittura del segmento compattato.")
+    for old_name, sha in segments.items():
+        if not delete_github_file(f"{GITHUB_REDEMPTIONS_DIR}/{old_name}", sha, "Compattazione riscatti"):
+            print(f"Impossibile cancellare {old_name}")
+    return len(segments), len(entries), name
+
+def format_redemption_log(entries):
+    """Segmento del log: una riga per riscatto, lotto<TAB>indice<TAB>user_id<TAB>ora."""
+    return "".join(f"{batch_id}\t{index}\t{user_id}\t{timestamp:.0f}\n" for batch_id, index, user_id, timestamp in entries).encode("utf-8")
+
+def parse_redemption_log(data):
+    for line in data.decode("utf-8").splitlines():
+        fields = line.split("\t")
+        if len(fields) == 4:
+            yield fields[0], int(fields[1]), fields[2], float(fields[3])
+
+one_time_codes = OneTimeCodes(CODES_SECRET, CODES_REFRESH_INTERVAL)
+
+class FileIdCache:
+    """Cache persistente chiave (es. nome della carta) -> file_id di Telegram.
+    Ogni voce è legata all'hash del contenuto: se l'immagine cambia, il file_id non viene riusato."""
+
+    def __init__(self):
+        self._entries = None
+        self._hashes = {}  # path -> (mtime_ns, size, hash)
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = store.load_file_ids()
+            # Vecchie voci degli album indicizzate per hash (album:<sha256>), ora sono una per utente
+            for key in [key for key in self._entries if key.startswith("album:") and len(key) == len("album:") + 64]:
+                del self._entries[key]
+                store.put_file_id(key, None, None)
+        return self._entries
+
+    def __len__(self):
+        return len(self._load())
+
+    def image_hash(self, path):
+        """Hash SHA-256 del file, ricalcolato solo se il file è cambiato su disco."""
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def get(self, key, digest):
+        entry = self._load().get(key)
+        if entry and entry[0] == digest:
+            return entry[1]
+        return None
+
+    def put(self, key, digest, file_id):
+        self._load()[key] = (digest, file_id)
+        store.put_file_id(key, digest, file_id)
+
+    def invalidate(self, key):
+        if self._load().pop(key, None) is not None:
+            store.put_file_id(key, None, None)
+
+file_ids = FileIdCache()
+
+class DisplayNames:
+    """Nomi Telegram degli utenti per la classifica, aggiornati da qualsiasi comando.
+    Sono dati personali: vengono salvati solo nell'archivio locale, mai nello snapshot su GitHub."""
+
+    def __init__(self):
+        self._names = None
+
+    def _load(self):
+        if self._names is None:
+            self._names = store.load_names()
+        return self._names
+
+    def remember(self, user):
+        user_id = str(user.id)
+        if user.first_name and self._load().get(user_id) != user.first_name:
+            self._names[user_id] = user.first_name
+            store.put_name(user_id, user.first_name)
+
+    def get(self, user_id):
+        return self._load().get(user_id)
+
+display_names = DisplayNames()
+
+def is_stale_file_id(error):
+    """True se Telegram ha rifiutato il file_id (e non, ad esempio, la didascalia o il parse_mode)."""
+    message = str(error).lower()
+    return "file identifier" in message or "file_id" in message or "file reference" in message
+
+async def send_cached_photo(bot, chat_id, key, image_path, **kwargs):
+    """Invia un'immagine riusando il file_id di Telegram se già caricata, altrimenti la carica e ne salva il file_id."""
+    digest = file_ids.image_hash(image_path)
+    file_id = file_ids.get(key, digest)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if not is_stale_file_id(e):
+                raise
+            # file_id non più valido: lo scarta e ricarica l'immagine
+            print(f"file_id non valido per {key}: {e}")
+            file_ids.invalidate(key)
+
+    with open(image_path, "rb") as photo:
+        message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    file_ids.put(key, digest, message.photo[-1].file_id)
+    return message
+
+async def send_cached_media_group(bot, chat_id, items):
+    """Invia un album di immagini riusando i file_id in cache. items è una lista di (chiave, path, didascalia)."""
+    digests = [file_ids.image_hash(path) for _, path, _ in items]
+    use_cache = True
+    while True:
+        with ExitStack() as stack:
+            media = []
+            cached_keys = []
+            for (key, path, caption), digest in zip(items, digests):
+                file_id = file_ids.get(key, digest) if use_cache else None
+                if file_id:
+                    cached_keys.append(key)
+                    photo = file_id
+                else:
+                    photo = stack.enter_context(open(path, "rb"))
+                media.append(InputMediaPhoto(photo, caption=caption))
+            try:
+                messages = await bot.send_media_group(chat_id=chat_id, media=media)
+                break
+            except BadRequest as e:
+                if not cached_keys or not is_stale_file_id(e):
+                    raise
+                # Almeno un file_id non è più valido: li scarta e ricarica tutte le immagini
+                print(f"file_id non validi nell'album: {e}")
+                for key in cached_keys:
+                    file_ids.invalidate(key)
+                use_cache = False
+
+    for (key, _, _), digest, message in zip(items, digests, messages):
+        if message.photo:
+            file_ids.put(key, digest, message.photo[-1].file_id)
+    return messages
+
+def card_image_path(card):
+    return os.path.join(IMAGE_DIR, f"{normalize_filename(card)}.png")
 
 def normalize_filename(text):
     # Rimuove caratteri non validi per i nomi di file
     return re.sub(r'[<>:"/\\|?*]', '', text)
         
+MARKDOWN_ESCAPE_TABLE = str.maketrans({char: f'\\{char}' for char in '_*[]()~`>#+-=|{}.!'})
+
 def escape_markdown(text):
-    escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
-
-# Funzione per salvare le collezioni degli utenti
-def save_collections():
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_FILE_PATH}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    response = requests.get(url, headers=headers)
-    sha = response.json().get('sha', None)
+    return text.translate(MARKDOWN_ESCAPE_TABLE)
 
-    data = json.dumps(user_collections, indent=4)
-    encoded_data = b64encode(data.encode('utf-8')).decode('utf-8')
+# Funzione per salvare uno shard delle collezioni (bloccante: va eseguita fuori dall'event loop)
+def save_collections(index, data, sha):
+    """Scrive lo shard solo se su GitHub c'è ancora la versione sha.
+    Ritorna ("ok", nuovo sha), ("conflitto", None) se qualcun altro l'ha modificato, o ("errore", None)."""
+    url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO}/contents/{shard_path(index)}"
+    # L'API contents accetta solo base64: lo shard è già compresso, quindi il peso resta contenuto
+    encoded_data = b64encode(data).decode('utf-8')
 
     payload = {
-        "message": "Aggiornamento collezioni utenti",
-        "content": encoded_data,
-        "sha": sha
+        "message": f"Aggiornamento collezioni utenti (shard {index})",
+        "content": encoded_data
     }
+    if sha:
+        payload["sha"] = sha
     
-    save_response = requests.put(url, headers=headers, json=payload)
+    save_response = github_request("PUT", url, headers=github_headers(), json=payload)
     
-    if save_response.status_code == 200:
-        print("Collezioni salvate con successo su GitHub.")
+    if save_response.status_code in (200, 201):
+        return "ok", save_response.json()["content"]["sha"]
+    # 409: sha non aggiornato, 422: sha mancante per un file che esiste già
+    if save_response.status_code in (409, 422):
+        print(f"Conflitto nel salvataggio dello shard {index}: è cambiato su GitHub.")
+        return "conflitto", None
+    print(f"Errore nel salvataggio dello shard {index} ({save_response.status_code}): {save_response.text}")
+    return "errore", None
+
+def fetch_shard_with_sha(index):
+    """Versione remota attuale di uno shard: (record, sha)."""
+    shards = list_snapshot_shards() or {}
+    if index not in shards:
+        return {}, None
+    return fetch_verified_shard(index, shards[index])
+
+def merge_collection_records(local, remote):
+    """Unisce due versioni dello stesso utente modificate da istanze diverse del bot.
+    Le carte si possono solo aggiungere, quindi si prende l'unione; pacchetti e ricarica vengono dalla
+    versione con l'apertura più recente. Un /reset più recente dell'altra versione vince su tutto."""
+    local_reset, remote_reset = local.get("reset") or "", remote.get("reset") or ""
+    if local_reset != remote_reset:
+        return dict(local if local_reset > remote_reset else remote)
+    if (local.get("last_opened") or "") >= (remote.get("last_opened") or ""):
+        merged = {**remote, **local}
     else:
-        print(f"Errore nel salvataggio: {save_response.json()}")
+        merged = {**local, **remote}
+    for rarity in RARITIES:
+        cards = list(local.get(rarity, ()))
+        owned = set(cards)
+        cards += [card for card in remote.get(rarity, ()) if card not in owned]
+        merged[rarity] = cards
+    return merged
+
+# Tentativi massimi di salvataggio per flush in caso di conflitti
+MAX_SYNC_ATTEMPTS = int(os.environ.get("MAX_SYNC_ATTEMPTS", 5))
+
+class SaveQueue:
+    """Coda di salvataggio write-behind con sincronizzazione a delta su snapshot a shard.
+
+    Ogni modifica va subito nell'archivio locale e l'utente viene segnato come delta da
+    sincronizzare (anche su disco, così sopravvive a un riavvio). Il flush periodico riscrive
+    solo gli shard che contengono utenti modificati, in parallelo, ciascuno con l'ultimo sha noto;
+    se un'altra istanza del bot ha modificato uno shard nel frattempo, scarica la copia remota,
+    adotta gli utenti che non abbiamo modificato, mantiene i nostri delta e riprova con backoff
+    esponenziale. Così più worker possono condividere lo stesso snapshot senza cancellarsi le carte."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.dirty = set()
+        self.shas = {}  # indice shard -> sha su GitHub su cui si basa la copia in memoria
+        self.members = {}  # indice shard -> user_id salvati in quello shard
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.conflicts = 0
+        self.last_flush_latency = None
+        self.last_flush_time = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def mark_dirty(self, user_id):
+        """Salva l'utente nell'archivio locale e lo segna per il prossimo snapshot."""
+        collection = user_collections.get(user_id)
+        store.put(user_id, collection.to_json() if collection is not None else None)
+        if collection is not None:
+            self.members.setdefault(shard_index(user_id), set()).add(user_id)
+        else:
+            self.members.get(shard_index(user_id), set()).discard(user_id)
+        if user_id not in self.dirty:
+            store.add_pending((user_id,))
+            self.dirty.add(user_id)
+
+    def set_sha(self, index, sha):
+        """Aggiorna lo sha dello shard anche nell'archivio locale: dopo un riavvio dall'archivio
+        il primo flush riparte dallo sha giusto invece di passare da un conflitto."""
+        if sha is None:
+            self.shas.pop(index, None)
+        else:
+            self.shas[index] = sha
+        store.set_state("sha_shard", json.dumps(self.shas))
+
+    def rebuild_members(self, user_ids):
+        """Ricostruisce l'indice shard -> utenti, così un flush serializza solo gli shard modificati."""
+        self.members = {}
+        for user_id in user_ids:
+            self.members.setdefault(shard_index(user_id), set()).add(user_id)
+
+    @property
+    def depth(self):
+        return len(self.dirty)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "flush_count": self.flush_count,
+            "failed_flushes": self.failed_flushes,
+            "conflicts": self.conflicts,
+            "last_flush_latency": self.last_flush_latency,
+            "last_flush_time": self.last_flush_time,
+        }
+
+    def merge_remote(self, remote, local_changes):
+        """Adotta dalla copia remota gli utenti che non abbiamo modificato localmente e unisce quelli
+        modificati da entrambe le parti (la nostra copia di un utente può essere vecchia)."""
+        adopted = 0
+        for user_id, record in remote.items():
+            local = user_collections.get(user_id)
+            if user_id in local_changes:
+                if local is None:
+                    continue  # Cancellato qui: la cancellazione resta
+                record = merge_collection_records(local.to_json(), record)
+            if local is not None and local.to_json() == record:
+                continue
+            user_collections[user_id] = Collection.from_json(record)
+            collection_stats.on_collection_replaced(user_id, local, user_collections[user_id])
+            store.put(user_id, record)
+            self.members.setdefault(shard_index(user_id), set()).add(user_id)
+            adopted += 1
+        return adopted
+
+    async def _sync_shard(self, index, users):
+        """Scrive uno shard, risolvendo i conflitti. Ritorna il numero di byte scritti, o None se non è riuscito."""
+        for attempt in range(MAX_SYNC_ATTEMPTS):
+            # Serializza nell'event loop, così il thread non legge il dizionario mentre cambia
+            records = {}
+            for user_id in self.members.get(index, ()):
+                collection = user_collections.get(user_id)
+                if collection is not None:
+                    records[user_id] = collection.to_json()
+            data = encode_shard(records)
+            outcome, sha = await asyncio.to_thread(save_collections, index, data, self.shas.get(index))
+            if outcome == "ok":
+                self.set_sha(index, sha)
+                return len(data)
+            if outcome != "conflitto":
+                return None
+
+            self.conflicts += 1
+            metrics.inc("sbit_sync_conflicts_total")
+            remote, remote_sha = await asyncio.to_thread(fetch_shard_with_sha, index)
+            # I delta da preservare sono quelli in volo più quelli arrivati durante il flush
+            adopted = self.merge_remote(remote, users | self.dirty)
+            self.set_sha(index, remote_sha)
+            print(f"Conflitto sullo shard {index} risolto: adottati {adopted} utenti dalla copia remota.")
+            await asyncio.sleep(min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        return None
+
+    async def flush(self):
+        """Scrive su GitHub gli shard con modifiche. Ritorna False se almeno uno shard non è stato salvato.
+        Finché non è stato caricato uno snapshot verificato non scrive niente: uno shard riscritto a partire
+        da collezioni incomplete cancellerebbe le carte degli altri utenti."""
+        async with self._lock:
+            if not self.dirty:
+                return True
+            if not startup.verified:
+                print(f"Salvataggio rimandato: snapshot non ancora verificato ({len(self.dirty)} utenti in attesa).")
+                return False
+            users, self.dirty = self.dirty, set()
+            shards = sorted({shard_index(user_id) for user_id in users})
+            start = time.monotonic()
+            results = await asyncio.gather(
+                *(self._sync_shard(index, users) for index in shards), return_exceptions=True
+            )
+            self.last_flush_latency = time.monotonic() - start
+            self.last_flush_time = datetime.now().isoformat()
+
+            failed = set()
+            written = 0
+            for index, result in zip(shards, results):
+                if isinstance(result, Exception):
+                    print(f"Errore durante il salvataggio dello shard {index}: {result}")
+                    failed.add(index)
+                elif result is None:
+                    failed.add(index)
+                else:
+                    written += result
+            metrics.set("sbit_last_save_bytes", written)
+
+            saved_users = {user_id for user_id in users if shard_index(user_id) not in failed}
+            # I delta sincronizzati non sono più in sospeso (a meno che non siano cambiati di nuovo)
+            store.remove_pending(saved_users - self.dirty)
+            if failed:
+                # Rimetti in coda gli utenti non salvati
+                self.failed_flushes += 1
+                self.dirty |= users - saved_users
+            else:
+                self.flush_count += 1
+            print(f"Flush di {len(users)} utenti su {len(shards)} shard ({written} byte) in "
+                  f"{self.last_flush_latency:.2f}s (in coda: {self.depth}, shard non salvati: {len(failed)})")
+            return not failed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Ferma il flush periodico e salva le ultime modifiche."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+save_queue = SaveQueue(SAVE_INTERVAL)
+
+def collect_state_metrics(registry):
+    registry.set("sbit_user_collections", len(user_collections))
+    registry.set("sbit_save_queue_depth", save_queue.depth)
+    if save_queue.last_flush_latency is not None:
+        registry.set("sbit_last_flush_seconds", save_queue.last_flush_latency)
+    registry.set("sbit_flushes", save_queue.flush_count)
+    registry.set("sbit_failed_flushes", save_queue.failed_flushes)
+    registry.set("sbit_send_queue_depth", send_scheduler.queue_size())
+    registry.set("sbit_user_locks", len(user_locks))
+    registry.set("sbit_catalog_cards", len(card_catalog.entries))
+    registry.set("sbit_refill_notifications_scheduled", len(refill_notifier))
+    registry.set("sbit_cards_without_image", len(card_catalog.missing_images))
+
+metrics.collectors.append(collect_state_metrics)
+
+class CardEntry:
+    """Dati precalcolati di una carta del catalogo."""
+
+    __slots__ = ("card_id", "rarity", "name", "image_path", "has_image", "escaped")
+
+    def __init__(self, card_id, rarity, name, image_path, has_image):
+        self.card_id = card_id  # Ordinale in card_index, stabile tra un caricamento e l'altro
+        self.rarity = rarity
+        self.name = name
+        self.image_path = image_path
+        self.has_image = has_image
+        self.escaped = escape_markdown(name)  # Per MarkdownV2
+
+class CardCatalog:
+    """Catalogo delle carte letto dai file di testo, con i dati di ogni carta calcolati una volta sola.
+
+    Il catalogo viene ricaricato quando cambiano i file delle carte o il contenuto di IMAGE_DIR:
+    la lettura avviene fuori dall'event loop e il nuovo stato sostituisce il vecchio in un solo passo,
+    poi vengono avvisati i listener (estrattore, statistiche, album...)."""
+
+    def __init__(self, card_files, image_dir, poll_interval):
+        self.card_files = card_files
+        self.image_dir = image_dir
+        self.poll_interval = poll_interval
+        self.cards = {}  # rarità -> lista dei nomi, nell'ordine dei file
+        self.entries = {}  # nome -> CardEntry
+        self.missing_images = []  # Carte senza un'immagine corrispondente
+        self.signature = None
+        self.listeners = []
+        self._task = None
+
+    def current_signature(self):
+        """mtime dei file delle carte e della cartella delle immagini (cambia se un'immagine viene aggiunta,
+        rimossa o rinominata)."""
+        paths = list(self.card_files.values()) + [self.image_dir]
+        signature = []
+        for path in paths:
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def read(self):
+        """Legge i file (bloccante). Ritorna (firma, carte, immagini presenti), o None se i file sono
+        cambiati durante la lettura: si riproverà al prossimo controllo."""
+        signature = self.current_signature()
+        cards = {}
+        for rarity, file_name in self.card_files.items():
+            with open(file_name, "r") as file:
+                cards[rarity] = [line.strip() for line in file if line.strip()]
+        try:
+            images = set(os.listdir(self.image_dir))
+        except FileNotFoundError:
+            images = set()
+        if self.current_signature() != signature:
+            return None
+        return signature, cards, images
+
+    def apply(self, state):
+        """Sostituisce il catalogo con quello letto da read()."""
+        signature, cards, images = state
+        entries = {}
+        for rarity, names in cards.items():
+            for name in names:
+                image_path = card_image_path(name)
+                entries[name] = CardEntry(card_index.intern(name), rarity, name, image_path, os.path.basename(image_path) in images)
+        self.cards = cards
+        self.entries = entries
+        self.missing_images = [entry.name for entry in entries.values() if not entry.has_image]
+        self.signature = signature
+        print(f"Catalogo caricato: {len(entries)} carte, {len(self.missing_images)} senza immagine.")
+        for listener in self.listeners:
+            listener(self)
+
+    def load(self):
+        """Caricamento sincrono, usato all'avvio."""
+        state = None
+        while state is None:
+            state = self.read()
+        self.apply(state)
+
+    def entry(self, name):
+        return self.entries.get(name)
+
+    async def reload_if_changed(self):
+        if await asyncio.to_thread(self.current_signature) == self.signature:
+            return False
+        state = await asyncio.to_thread(self.read)
+        if state is None:
+            return False
+        self.apply(state)
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload_if_changed()
+            except Exception as e:
+                print(f"Errore nel ricaricamento del catalogo: {e}")
 
-# Carica le carte dai file di testo
-def load_cards():
-    cards = {}
-    for rarity, file_name in CARD_FILES.items():
-        with open(file_name, "r") as file:
-            cards[rarity] = [line.strip() for line in file.readlines()]
-    return cards
+    def start(self):
+        if self._task is None and self.poll_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._watch())
 
-CARDS = load_cards()  # Carica tutte le carte
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+card_catalog = CardCatalog(CARD_FILES, IMAGE_DIR, CATALOG_POLL_INTERVAL)
+card_catalog.load()
+CARDS = card_catalog.cards  # Riassegnato a ogni ricaricamento del catalogo
+
+# Nomi delle carte già escapati per MarkdownV2
+ESCAPED_CARD_NAMES = {name: entry.escaped for name, entry in card_catalog.entries.items()}
+
+class PackSampler:
+    """Estrattore precalcolato per i pacchetti.
+
+    La rarità si sceglie con bisect sulle probabilità cumulative, equivalente al vecchio ciclo
+    cumulativo su random.randint(1, 100); poi la carta viene scelta uniformemente nella rarità.
+    Consuma i numeri casuali nello stesso ordine, quindi a parità di seed estrae le stesse carte."""
+
+    def __init__(self, probabilities, cards):
+        self.rarities = list(probabilities)
+        self.cumulative = list(accumulate(probabilities.values()))
+        self.cards = {rarity: tuple(cards[rarity]) for rarity in self.rarities}
+
+    def draw_rarity(self, rng=random):
+        roll = rng.randint(1, 100)
+        index = bisect_left(self.cumulative, roll)
+        return self.rarities[index] if index < len(self.rarities) else None
+
+    def draw(self, rng=random):
+        """Ritorna (rarità, carta), oppure (None, None) se le probabilità non coprono il tiro."""
+        rarity = self.draw_rarity(rng)
+        if rarity is None:
+            return None, None
+        return rarity, rng.choice(self.cards[rarity])
+
+    def draw_many(self, count, rng=random):
+        return [self.draw(rng) for _ in range(count)]
+
+    def flat_cards(self):
+        """Tutte le carte in ordine di rarità: (rarità, carta), come indicizzate da draw_batch."""
+        return [(rarity, card) for rarity in self.rarities for card in self.cards[rarity]]
+
+    def card_probabilities(self):
+        """Probabilità di ogni carta di flat_cards() in un singolo pacchetto."""
+        bounds = [0] + self.cumulative
+        return [
+            (min(bounds[index + 1], 100) - min(bounds[index], 100)) / 100 / len(self.cards[rarity])
+            for index, rarity in enumerate(self.rarities)
+            for _ in self.cards[rarity]
+        ]
+
+    def draw_batch(self, size, rng):
+        """Versione vettoriale di draw() per le simulazioni (richiede numpy; rng è un numpy.random.Generator).
+        Stesso tiro 1-100 con bisect sulle cumulative e carta uniforme nella rarità.
+        Ritorna due array: indice della rarità e indice della carta in flat_cards() (-1 se il tiro non è coperto)."""
+        import numpy as np
+        rarity = np.searchsorted(np.array(self.cumulative), rng.integers(1, 101, size), side="left")
+        sizes = np.array([len(self.cards[r]) for r in self.rarities] + [0])
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        card = offsets[rarity] + (rng.random(size) * sizes[rarity]).astype(np.int64)
+        card[rarity == len(self.rarities)] = -1
+        return rarity, card
+
+pack_sampler = PackSampler(RARITY_PROBABILITIES, CARDS)
+
+class FenwickTree:
+    """Albero di Fenwick per somme prefisse con aggiornamenti O(log n)."""
+
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    def add(self, index, delta):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """Somma dei valori in [0, index]."""
+        total = 0
+        index += 1
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+class CollectionStats:
+    """Statistiche aggiornate a ogni modifica delle collezioni, senza mai scandire tutti gli utenti:
+    quanti giocatori possiedono ogni carta del catalogo e classifica per completamento.
+
+    La classifica raggruppa gli utenti per numero di carte possedute e tiene un albero di Fenwick
+    sui conteggi, così aggiornamenti e calcolo della posizione costano O(log n)."""
+
+    def __init__(self, cards):
+        self._reset(cards)
+
+    def _reset(self, cards):
+        self.cards = cards
+        self.card_rarity = {card: rarity for rarity, rarity_cards in cards.items() for card in rarity_cards}
+        self.total_cards = len(self.card_rarity)
+        self.owners = dict.fromkeys(self.card_rarity, 0)  # carta -> numero di possessori
+        self.owned = {}  # user_id -> carte del catalogo possedute
+        self.buckets = {}  # numero di carte -> user_id con quel numero
+        self.counts = FenwickTree(self.total_cards + 1)
+
+    def _catalog_cards(self, collection):
+        return [card for card, rarity in self.card_rarity.items() if collection.has(rarity, card)]
+
+    def _move(self, user_id, old, new):
+        if old:
+            self.buckets[old].discard(user_id)
+            if not self.buckets[old]:
+                del self.buckets[old]
+            self.counts.add(old, -1)
+        if new:
+            self.buckets.setdefault(new, set()).add(user_id)
+            self.counts.add(new, 1)
+            self.owned[user_id] = new
+        else:
+            self.owned.pop(user_id, None)
+
+    def on_card_added(self, user_id, rarity, card):
+        if self.card_rarity.get(card) != rarity:
+            return  # Carta esclusiva, fuori dal catalogo
+        self.owners[card] += 1
+        old = self.owned.get(user_id, 0)
+        self._move(user_id, old, old + 1)
+
+    def on_collection_replaced(self, user_id, old_collection, new_collection):
+        """Aggiorna le statistiche quando la collezione di un utente viene sostituita (reset, sincronizzazione)."""
+        if old_collection is not None:
+            for card in self._catalog_cards(old_collection):
+                self.owners[card] -= 1
+        owned = 0
+        if new_collection is not None:
+            for card in self._catalog_cards(new_collection):
+                self.owners[card] += 1
+                owned += 1
+        self._move(user_id, self.owned.get(user_id, 0), owned)
+
+    def rebuild(self, collections, cards=None):
+        """Ricalcola tutto da zero: solo all'avvio o quando cambia il catalogo."""
+        self._reset(cards if cards is not None else self.cards)
+        for user_id, collection in collections.items():
+            self.on_collection_replaced(user_id, None, collection)
+
+    def completion(self, user_id):
+        return self.owned.get(user_id, 0) / self.total_cards if self.total_cards else 0.0
+
+    def rank(self, user_id):
+        """Posizione in classifica (1 = primo), o None se l'utente non ha carte del catalogo."""
+        owned = self.owned.get(user_id)
+        if not owned:
+            return None
+        return self.counts.prefix(self.total_cards) - self.counts.prefix(owned) + 1
+
+    def top(self, limit):
+        """I migliori collezionisti come lista di (user_id, carte possedute)."""
+        result = []
+        for owned in sorted(self.buckets, reverse=True):
+            for user_id in sorted(self.buckets[owned]):
+                result.append((user_id, owned))
+                if len(result) == limit:
+                    return result
+        return result
+
+    def players(self):
+        return len(self.owned)
+
+    def rarest_owned(self, limit):
+        return heapq.nsmallest(limit, ((count, card) for card, count in self.owners.items() if count > 0))
+
+    def never_found(self):
+        return sum(1 for count in self.owners.values() if count == 0)
+
+collection_stats = CollectionStats(CARDS)
+
+def new_user_collection():
+    """Collezione vuota per un nuovo utente."""
+    collection = Collection()
+    collection.last_opened = None  # Timestamp per l'ultima apertura
+    collection.pack_reserve = INITIAL_PACKS   # Inizia con 10 pacchetti
+    return collection
+
+def refill_reserve(reserve, anchor, now):
+    """Regola di ricarica condivisa da /apri, /pacchetti, /riscatta, notifiche e simulatore.
+    Ritorna (riserva, anchor) aggiornati, in O(1) qualunque sia il tempo trascorso.
+
+    anchor (salvato in last_opened) è l'inizio del periodo di ricarica in corso: per ogni REFILL_INTERVAL
+    intero trascorso si aggiungono PACKS_PER_REFILL pacchetti fino a MAX_PACK_RESERVE, e il tempo avanzato
+    resta valido per la ricarica successiva. Con la riserva piena (anche oltre il massimo, grazie ai codici)
+    l'orologio è fermo: l'anchor segue l'ora attuale e la riserva non viene mai ridotta."""
+    if anchor is None or reserve >= MAX_PACK_RESERVE:
+        return reserve, now
+    periods = (now - anchor) // REFILL_INTERVAL
+    if periods <= 0:
+        return reserve, anchor
+    reserve = min(MAX_PACK_RESERVE, reserve + periods * PACKS_PER_REFILL)
+    if reserve >= MAX_PACK_RESERVE:
+        return reserve, now
+    return reserve, anchor + periods * REFILL_INTERVAL
+
+def refill_state(user_data, now):
+    """Riserva e anchor attuali della collezione, senza modificarla."""
+    reserve = user_data.pack_reserve if user_data.pack_reserve is not None else INITIAL_PACKS
+    anchor = datetime.fromisoformat(user_data.last_opened) if user_data.last_opened else None
+    return refill_reserve(reserve, anchor, now)
+
+def apply_refill(user_data, now=None):
+    """Applica alla collezione le ricariche maturate. Ritorna la riserva aggiornata."""
+    reserve, anchor = refill_state(user_data, now or datetime.now())
+    user_data.pack_reserve = reserve
+    user_data.last_opened = anchor.isoformat()
+    return reserve
+
+def next_refill_time(reserve, anchor):
+    """Momento della prossima ricarica, o None se la riserva è piena."""
+    if reserve >= MAX_PACK_RESERVE or anchor is None:
+        return None
+    return anchor + REFILL_INTERVAL
+
+def full_reserve_time(reserve, anchor):
+    """Momento in cui la riserva tornerà piena, o None se lo è già."""
+    if reserve >= MAX_PACK_RESERVE or anchor is None:
+        return None
+    return anchor + -(-(MAX_PACK_RESERVE - reserve) // PACKS_PER_REFILL) * REFILL_INTERVAL
+
+def format_time_remaining(delta):
+    total = max(0, int(delta.total_seconds()))
+    hours, remainder = divmod(total, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours} ore, {minutes} minuti e {seconds} secondi"
+
+# Notifiche "pacchetti pronti": quante inviarne insieme al massimo (il ritmo lo decide send_scheduler)
+NOTIFICATION_BATCH_SIZE = 30
+
+class RefillNotifier:
+    """Avvisa gli utenti che l'hanno chiesto (/notifiche) quando la riserva di pacchetti è di nuovo piena.
+
+    Un unico heap di (scadenza, user_id, generazione) per tutti gli utenti e un unico task che dorme
+    fino alla prossima scadenza: niente polling né job per utente. Riprogrammare o annullare un avviso
+    incrementa la generazione dell'utente, e le voci vecchie vengono scartate quando escono dall'heap."""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._heap = []
+        self._generations = {}  # user_id -> generazione dell'avviso valido
+        self._wakeup = None
+        self._task = None
+        self.bot = None
+        self.sent = 0
+
+    def __len__(self):
+        return len(self._generations)
+
+    def _push(self, user_id, due):
+        generation = self._generations.get(user_id, 0) + 1
+        self._generations[user_id] = generation
+        heapq.heappush(self._heap, (due.timestamp(), user_id, generation))
+        if self._wakeup is not None and self._heap[0][1] == user_id:
+            self._wakeup.set()  # Nuova scadenza più vicina: il task deve ricalcolare l'attesa
+
+    def cancel(self, user_id):
+        if self._generations.pop(user_id, None) is not None and len(self._heap) > 4 * len(self._generations) + 64:
+            # Troppe voci scadute: ricostruisce l'heap tenendo solo quelle valide
+            self._heap = [item for item in self._heap if self._generations.get(item[1]) == item[2]]
+            heapq.heapify(self._heap)
+
+    def update(self, user_id, user_data, now=None):
+        """Da chiamare dopo ogni modifica della riserva: (ri)programma o annulla l'avviso dell'utente."""
+        due = None
+        if user_data.notifications:
+            due = full_reserve_time(*refill_state(user_data, now or datetime.now()))
+        if due is None:
+            self.cancel(user_id)
+        else:
+            self._push(user_id, due)
+
+    def rebuild(self, collections):
+        """Ricostruisce l'heap da tutte le collezioni (all'avvio), con un solo heapify."""
+        now = datetime.now()
+        self._heap = []
+        self._generations = {}
+        for user_id, collection in collections.items():
+            if collection.notifications:
+                due = full_reserve_time(*refill_state(collection, now))
+                if due is not None:
+                    self._generations[user_id] = 1
+                    self._heap.append((due.timestamp(), user_id, 1))
+        heapq.heapify(self._heap)
+
+    def _pop_due(self):
+        """Estrae fino a batch_size avvisi scaduti e ancora validi."""
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            _, user_id, generation = heapq.heappop(self._heap)
+            if self._generations.get(user_id) == generation:
+                del self._generations[user_id]
+                due.append(user_id)
+        return due
+
+    async def _notify(self, user_id):
+        user_data = user_collections.get(user_id)
+        if user_data is None or not user_data.notifications:
+            return
+        reserve, anchor = refill_state(user_data, datetime.now())
+        if reserve < MAX_PACK_RESERVE:
+            # La riserva è cambiata senza passare da update(): riprova alla nuova scadenza
+            self._push(user_id, full_reserve_time(reserve, anchor))
+            return
+        try:
+            await self.bot.send_message(
+                chat_id=int(user_id),
+                text=f"🃏 I tuoi pacchetti sono pronti: ne hai {reserve} da aprire! Usa /apri.\n"
+                     "(Per non ricevere più questi avvisi: /notifiche)",
+                rate_limit_args=SendScheduler.BACKGROUND_PRIORITY
+            )
+            self.sent += 1
+            metrics.inc("sbit_refill_notifications_total")
+        except Exception as e:
+            print(f"Errore nell'invio della notifica a {user_id}: {e}")
+
+    async def _run(self):
+        while True:
+            if self._heap:
+                timeout = self._heap[0][0] - time.time()
+            else:
+                timeout = None
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = self._pop_due()
+            if batch:
+                await asyncio.gather(*(self._notify(user_id) for user_id in batch))
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+refill_notifier = RefillNotifier(NOTIFICATION_BATCH_SIZE)
 
 # Funzione per gestire l'apertura delle figurine
 async def apri(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /apri per aprire una figurina."""
+    """Comando /apri per aprire una figurina, oppure /apri <n> per aprire più pacchetti insieme."""
     try:
         # Inizio funzione, log di debug
         print("Comando /apri attivato.")
@@ -124,97 +2358,86 @@ async def apri(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # Verifica se l'utente ha già una collezione
         if user_id not in user_collections:
             print("Creazione nuova collezione per l'utente.")
-            user_collections[user_id] = {
-                "comune": [],
-                "rara": [],
-                "epica": [],
-                "leggendaria": [],
-                "last_opened": None,  # Timestamp per l'ultima apertura
-                "pack_reserve": 10   # Inizia con 10 pacchetti
-            }
+            user_collections[user_id] = new_user_collection()
+
+        # Numero di pacchetti da aprire (/apri <n>)
+        count = 1
+        if context.args:
+            try:
+                count = int(context.args[0])
+            except ValueError:
+                count = 0
+            if count < 1:
+                await update.message.reply_text("Per favore, usa il comando così: /apri <numero di pacchetti>")
+                return
+            count = min(count, MAX_PACKS_PER_COMMAND)
 
         # Recupera i dati dell'utente
         user_data = user_collections[user_id]
 
-        # Inizializza eventuali chiavi mancanti
-        user_data.setdefault("pack_reserve", 10)
-        user_data.setdefault("last_opened", None)
-
-        # Gestisci la riserva di pacchetti
-        last_opened = user_data.get("last_opened")
-        if last_opened:
-            last_opened_time = datetime.fromisoformat(last_opened)
-            time_diff = datetime.now() - last_opened_time
-            if time_diff >= timedelta(hours=12):
-                # Aggiungi fino a 5 pacchetti ogni 12 ore, senza superare il massimo di 10
-                additional_packs = min(5, 10 - user_data["pack_reserve"])
-                user_data["pack_reserve"] += additional_packs
-                user_data["last_opened"] = datetime.now().isoformat()
-        else:
-            # Imposta il timestamp iniziale se manca
-            user_data["last_opened"] = datetime.now().isoformat()
+        # Applica le ricariche maturate (imposta anche riserva e timestamp iniziali se mancano)
+        now = datetime.now()
+        apply_refill(user_data, now)
 
         # Verifica se ci sono pacchetti disponibili
-        if user_data["pack_reserve"] <= 0:
+        if user_data.pack_reserve <= 0:
             # Calcola il tempo mancante alla prossima ricarica
-            last_opened_time = datetime.fromisoformat(user_data["last_opened"])
-            next_refill_time = last_opened_time + timedelta(hours=12)
-            time_remaining = next_refill_time - datetime.now()
-
-            # Converti in ore, minuti e secondi
-            hours, remainder = divmod(time_remaining.seconds, 3600)
-            minutes, seconds = divmod(remainder, 60)
+            time_remaining = next_refill_time(user_data.pack_reserve, datetime.fromisoformat(user_data.last_opened)) - now
 
             # Messaggio personalizzato
             await update.message.reply_text(
                 f"Non hai pacchetti disponibili al momento.\n"
-                f"Tempo rimanente per la prossima ricarica: **{hours} ore, {minutes} minuti e {seconds} secondi**.",
+                f"Tempo rimanente per la prossima ricarica: **{format_time_remaining(time_remaining)}**.",
                 parse_mode="Markdown"
             )
             return
 
-        # Consuma un pacchetto
-        user_data["pack_reserve"] -= 1
+        # Consuma i pacchetti (al massimo quelli disponibili)
+        count = min(count, user_data.pack_reserve)
+        user_data.pack_reserve -= count
+        refill_notifier.update(user_id, user_data, now)
 
-        # Determina la rarità
-        roll = random.randint(1, 100)
-        print(f"Roll ottenuto: {roll}")
-        cumulative = 0
-        rarity = None
-        for r, probability in RARITY_PROBABILITIES.items():
-            cumulative += probability
-            if roll <= cumulative:
-                rarity = r
-                break
-
-        if rarity is None:
+        # Estrai tutte le carte in un solo passaggio
+        draws = pack_sampler.draw_many(count)
+        if any(rarity is None for rarity, _ in draws):
             await update.message.reply_text("Errore nel calcolo della rarità.", parse_mode="Markdown")
             return
 
-        print(f"Rarità estratta: {rarity}")
-
-        # Scegli una carta casuale
-        card = random.choice(CARDS[rarity])
-        print(f"Carta estratta: {card}")
+        new_cards = []
+        duplicates = []
+        for rarity, card in draws:
+            print(f"Carta estratta: {card} ({rarity})")
+            # Aggiungi la carta alla collezione dell'utente, se non la possiede già
+            if user_data.add(rarity, card):
+                collection_stats.on_card_added(user_id, rarity, card)
+                new_cards.append((rarity, card))
+            else:
+                duplicates.append((rarity, card))
+
+        # Un solo salvataggio per tutto il lotto (i pacchetti sono consumati anche se escono doppioni)
+        save_queue.mark_dirty(user_id)
+
+        if count > 1:
+            await send_pack_batch(update, context, count, new_cards, duplicates)
+            return
 
-        # Verifica se l'utente ha già questa carta
-        if card in user_data[rarity]:
+        rarity, card = draws[0]
+        if duplicates:
             await update.message.reply_text(f"🎉 Hai ottenuto una carta che hai già!\n✨ **{card}** ✨", parse_mode="Markdown")
             return
 
-        # Aggiungi la carta alla collezione dell'utente
-        user_data[rarity].append(card)
-        save_collections()  # Salva la collezione aggiornata
-
         # Path per l'immagine della carta
-        image_path = os.path.join("immagini", f"{normalize_filename(card)}.png")
+        entry = card_catalog.entry(card)
 
-        if os.path.isfile(image_path):
+        if entry is not None and entry.has_image:
+            image_path = entry.image_path
             try:
-                # Invia il messaggio con immagine e testo formattato
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=open(image_path, "rb"),
+                # Invia il messaggio con immagine e testo formattato (riusando il file_id se possibile)
+                await send_cached_photo(
+                    context.bot,
+                    update.effective_chat.id,
+                    card,
+                    image_path,
                     caption=f"🎉 {user.first_name}, hai ottenuto una nuova carta {rarity.upper()}:\n✨ **{card}** ✨!",
                     parse_mode="Markdown"
                 )
@@ -237,44 +2460,187 @@ async def apri(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception as e:
         # Gestisci errori generali e stampa i dettagli
         print(f"Errore generico nella funzione /apri: {e}")
+        metrics.inc("sbit_handler_errors_total", {"command": "apri"})
         await update.message.reply_text(
             "Si è verificato un errore durante l'elaborazione del comando. Riprova più tardi!",
             parse_mode="Markdown"
         )
 
+async def send_pack_batch(update, context, count, new_cards, duplicates):
+    """Invia il risultato di più pacchetti: un album con le nuove carte illustrate e un riepilogo testuale."""
+    items = []
+    for rarity, card in new_cards:
+        entry = card_catalog.entry(card)
+        if entry is not None and entry.has_image:
+            items.append((card, entry.image_path, f"{rarity.upper()}: {card}"))
+
+    try:
+        if len(items) == 1:
+            card, image_path, caption = items[0]
+            await send_cached_photo(context.bot, update.effective_chat.id, card, image_path, caption=caption)
+        elif items:
+            await send_cached_media_group(context.bot, update.effective_chat.id, items)
+    except Exception as e:
+        # Il riepilogo viene comunque inviato
+        print(f"Errore durante l'invio dell'album: {e}")
+
+    # MarkdownV2 con i nomi già escapati: con il Markdown legacy un "_" isolato nel nome (es. Signor_Lei)
+    # farebbe fallire l'invio dopo che i pacchetti sono già stati aperti
+    def card_line(rarity, card):
+        return f"\\- {rarity.upper()}: {ESCAPED_CARD_NAMES.get(card) or escape_markdown(card)}"
+
+    summary = f"🎉 Hai aperto {count} pacchetti\\!\n"
+    if new_cards:
+        summary += "\n✨ *Nuove carte:*\n" + "\n".join(card_line(rarity, card) for rarity, card in new_cards) + "\n"
+    if duplicates:
+        summary += "\n🔁 *Doppioni:*\n" + "\n".join(card_line(rarity, card) for rarity, card in duplicates) + "\n"
+    await update.message.reply_text(summary, parse_mode="MarkdownV2")
+    print(f"Lotto di {count} pacchetti: {len(new_cards)} nuove carte, {len(duplicates)} doppioni.")
+
+# Lunghezza massima di una pagina di /collezione (margine sotto il limite di 4096 caratteri di Telegram)
+COLLECTION_PAGE_LIMIT = 3500
+
+# Numero massimo di collezioni renderizzate tenute in cache
+COLLECTION_CACHE_SIZE = int(os.environ.get("COLLECTION_CACHE_SIZE", 512))
+
+COLLECTION_CALLBACK_PREFIX = "coll|"
+
+RARITY_PLURALS = {
+    "comune": "Comuni",
+    "rara": "Rare",
+    "epica": "Epiche",
+    "leggendaria": "Leggendarie"
+}
+
+def render_collection(collection):
+    """Divide le carte possedute in pagine per rarità, nell'ordine dei file. Ritorna {rarità: [pagine]}."""
+    pages = {}
+    for rarity in RARITIES:
+        if not collection.owns_any(rarity):
+            continue
+        lines = [ESCAPED_CARD_NAMES[card] for card in CARDS[rarity] if collection.has(rarity, card)]
+        # Le carte esclusive (assenti dai file) vanno in fondo
+        lines += [escape_markdown(card) for card in collection.cards(rarity) if card not in ESCAPED_CARD_NAMES]
+
+        chunks = []
+        current = []
+        size = 0
+        for line in lines:
+            if current and size + len(line) + 1 > COLLECTION_PAGE_LIMIT:
+                chunks.append("\n".join(current))
+                current = []
+                size = 0
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            chunks.append("\n".join(current))
+        pages[rarity] = chunks
+    return pages
+
+class CollectionPageCache:
+    """Cache LRU delle pagine di /collezione, indicizzata per utente e versione della collezione."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, user_id, collection):
+        key = (user_id, collection.version)
+        pages = self._entries.get(key)
+        if pages is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pages
+        self.misses += 1
+        pages = render_collection(collection)
+        self._entries[key] = pages
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return pages
+
+collection_pages = CollectionPageCache(COLLECTION_CACHE_SIZE)
+
+def collection_view(user_id, first_name, pages, rarity=None, page=0):
+    """Testo e tastiera di una pagina di /collezione. Se tutta la collezione sta in un messaggio, niente pulsanti."""
+    header = f"🎴 **Collezione di {escape_markdown(first_name)}:**\n\n"
+
+    if rarity is None:
+        total = sum(len(chunk) + 32 for chunks in pages.values() for chunk in chunks)
+        if total <= COLLECTION_PAGE_LIMIT and all(len(chunks) == 1 for chunks in pages.values()):
+            body = "".join(f"**{RARITY_PLURALS[r]}:**\n{chunks[0]}\n\n" for r, chunks in pages.items())
+            return header + body, None
+        rarity = next(iter(pages))
+
+    chunks = pages[rarity]
+    page = max(0, min(page, len(chunks) - 1))
+    title = f"**{RARITY_PLURALS[rarity]}:**"
+    if len(chunks) > 1:
+        title += escape_markdown(f" (pagina {page + 1}/{len(chunks)})")
+    text = f"{header}{title}\n{chunks[page]}\n"
+
+    # Una riga con le rarità possedute e una per scorrere le pagine
+    rarity_row = [
+        InlineKeyboardButton(
+            f"• {RARITY_PLURALS[r]} •" if r == rarity else RARITY_PLURALS[r],
+            callback_data=f"{COLLECTION_CALLBACK_PREFIX}{user_id}|{r}|0"
+        )
+        for r in pages
+    ]
+    keyboard = [rarity_row]
+    if len(chunks) > 1:
+        page_row = []
+        if page > 0:
+            page_row.append(InlineKeyboardButton("◀️", callback_data=f"{COLLECTION_CALLBACK_PREFIX}{user_id}|{rarity}|{page - 1}"))
+        if page < len(chunks) - 1:
+            page_row.append(InlineKeyboardButton("▶️", callback_data=f"{COLLECTION_CALLBACK_PREFIX}{user_id}|{rarity}|{page + 1}"))
+        keyboard.append(page_row)
+    return text, InlineKeyboardMarkup(keyboard)
+
 # Comando per visualizzare la collezione dell'utente
 async def collezione(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /collezione per visualizzare le carte possedute dall'utente nell'ordine dei file e con le rarità al plurale."""
     user = update.effective_user
     user_id = str(user.id)
 
-    if user_id not in user_collections or not any(user_collections[user_id].values()):
+    if user_id not in user_collections or user_collections[user_id].is_empty():
         await update.message.reply_text("Non hai ancora ottenuto nessuna carta!", parse_mode="Markdown")
         return
 
-    # Crea un messaggio con la collezione dell'utente, suddivisa per rarità
-    collection_message = f"🎴 **Collezione di {escape_markdown(user.first_name)}:**\n\n"
-    
-    for rarity in ["comune", "rara", "epica", "leggendaria"]:
-        owned_cards = user_collections[user_id][rarity]
-        if owned_cards:
-            if rarity == "comune":
-                rarity_plural = "Comuni"
-            elif rarity == "rara":
-                rarity_plural = "Rare"
-            elif rarity == "epica":
-                rarity_plural = "Epiche"
-            elif rarity == "leggendaria":
-                rarity_plural = "Leggendarie"
-                
-            collection_message += f"**{rarity_plural}:**\n"
-            
-            # Escapa ogni carta prima di aggiungerla al messaggio
-            ordered_cards = [escape_markdown(card) for card in CARDS[rarity] if card in owned_cards]
-            collection_message += "\n".join(ordered_cards) + "\n\n"
+    # Pagine già escapate, ricalcolate solo quando la collezione cambia
+    pages = collection_pages.get(user_id, user_collections[user_id])
+    text, reply_markup = collection_view(user_id, user.first_name, pages)
 
     # Usa MarkdownV2 per una formattazione più sicura
-    await update.message.reply_text(collection_message, parse_mode="MarkdownV2")
+    await update.message.reply_text(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
+
+async def show_collection_page(query):
+    """Gestisce i pulsanti di navigazione di /collezione."""
+    _, user_id, rarity, page = query.data.split("|")
+    if str(query.from_user.id) != user_id:
+        await query.answer("Questa non è la tua collezione!")
+        return
+    await query.answer()
+
+    collection = user_collections.get(user_id)
+    if collection is None or collection.is_empty():
+        await query.edit_message_text("Non hai ancora ottenuto nessuna carta!")
+        return
+
+    pages = collection_pages.get(user_id, collection)
+    if rarity not in pages:
+        rarity = None
+    text, reply_markup = collection_view(user_id, query.from_user.first_name, pages, rarity, int(page))
+    try:
+        await query.edit_message_text(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
+    except BadRequest as e:
+        # Stessa pagina già visualizzata
+        if "not modified" not in str(e):
+            raise
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Usa il comando /start per iniziare!"""
@@ -288,10 +2654,14 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Usa il comando /help per sapere tutto quello che c'è da sapere!"""
     await update.message.reply_text(
         "🎴 **Comandi disponibili:**\n"
-        "- /apri: Scopri quale carta ottieni!\n"
+        "- /apri: Scopri quale carta ottieni! (/apri <n> per aprire più pacchetti insieme)\n"
         "- /pacchetti: Controlla il numero di pacchetti disponibili.\n"
+        "- /notifiche: Ricevi un avviso quando i tuoi pacchetti sono di nuovo pronti.\n"
         "- /collezione: Visualizza la tua collezione!\n"
         "- /riscatta: Riscatta un codice!\n"
+        "- /album: Guarda le tue carte illustrate in un'unica immagine!\n"
+        "- /classifica: Scopri i migliori collezionisti!\n"
+        "- /statistiche: Scopri quante persone possiedono ogni carta.\n"
         "- /reset: Cancella la tua collezione.\n"
         "- /bash: Iscriviti al Raffo's Birthday Bash!\n"
         "- /about: Informazioni sul bot.\n"
@@ -319,32 +2689,108 @@ async def pacchetti(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Verifica se l'utente ha una collezione
     if user_id not in user_collections:
-        user_collections[user_id] = {
-            "comune": [],
-            "rara": [],
-            "epica": [],
-            "leggendaria": [],
-            "last_opened": None,
-            "pack_reserve": 10  # Inizia con 10 pacchetti se non esistono dati
-        }
+        user_collections[user_id] = new_user_collection()  # Inizia con 10 pacchetti se non esistono dati
 
-    # Recupera i dati dell'utente, assicurandosi che la chiave "pack_reserve" sia presente
-    user_data = user_collections[user_id]
+    # Riserva attuale, ricariche maturate comprese (calcolata senza modificare la collezione)
+    now = datetime.now()
+    pack_reserve, anchor = refill_state(user_collections[user_id], now)
 
-    # Imposta "pack_reserve" se manca
-    if "pack_reserve" not in user_data:
-        user_data["pack_reserve"] = 10  # Imposta un valore di default
+    text = f"🃏 **Aperture rimanenti:** {pack_reserve}"
+    refill_time = next_refill_time(pack_reserve, anchor)
+    if refill_time is not None:
+        text += f"\n⏳ Prossima ricarica (+{PACKS_PER_REFILL}) tra: **{format_time_remaining(refill_time - now)}**"
+    await update.message.reply_text(text, parse_mode="Markdown")
+    
+async def notifiche(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /notifiche per attivare o disattivare l'avviso "pacchetti pronti" (/notifiche on|off, senza argomenti lo inverte)."""
+    user_id = str(update.effective_user.id)
+    user_data = user_collections.setdefault(user_id, new_user_collection())
+
+    choice = context.args[0].lower() if context.args else None
+    if choice in ("on", "si", "sì"):
+        enabled = True
+    elif choice in ("off", "no"):
+        enabled = False
+    elif choice is None:
+        enabled = not user_data.notifications
+    else:
+        await update.message.reply_text("Per favore, usa il comando così: /notifiche [on|off]")
+        return
 
-    # Recupera il numero di pacchetti rimanenti
-    pack_reserve = user_data["pack_reserve"]
+    user_data.notifications = enabled
+    save_queue.mark_dirty(user_id)
+    refill_notifier.update(user_id, user_data)
+
+    if enabled:
+        await update.message.reply_text(
+            f"🔔 Notifiche attivate: ti scriverò quando avrai di nuovo {MAX_PACK_RESERVE} pacchetti da aprire."
+        )
+    else:
+        await update.message.reply_text("🔕 Notifiche disattivate.")
+
+# Tipi di premio dei codici: nome -> (funzione, parametri obbligatori).
+# Ogni funzione assegna il premio alla collezione e ritorna il messaggio per l'utente.
+REWARDS = {}
+
+def reward_type(name, *params):
+    def register(function):
+        REWARDS[name] = (function, params)
+        return function
+    return register
+
+def validate_reward(reward):
+    """Controlla che il premio esista e abbia i parametri richiesti (ValueError altrimenti)."""
+    if reward.get("reward") not in REWARDS:
+        raise ValueError(f"Premio sconosciuto. Premi disponibili: {', '.join(sorted(REWARDS))}")
+    _, params = REWARDS[reward["reward"]]
+    missing = [param for param in params if param not in reward]
+    if missing:
+        raise ValueError(f"Parametri mancanti per {reward['reward']}: {', '.join(missing)}")
+    if "amount" in reward and not str(reward["amount"]).isdigit():
+        raise ValueError("amount deve essere un numero intero positivo.")
+    if "rarity" in reward and reward["rarity"] not in CARDS:
+        raise ValueError(f"Rarità sconosciuta. Rarità disponibili: {', '.join(RARITIES)}")
+
+def grant_reward(user_id, reward):
+    user_data = user_collections.setdefault(user_id, new_user_collection())
+    entry = REWARDS.get(reward.get("reward"))
+    if entry is None:
+        return "Codice riscattato!"
+    return entry[0](user_id, user_data, reward)
+
+def add_packs(user_data, amount):
+    # Prima le ricariche maturate, così i pacchetti regalati non fanno perdere tempo di ricarica
+    user_data.pack_reserve = apply_refill(user_data) + amount
+
+@reward_type("10_pacchetti")
+def reward_ten_packs(user_id, user_data, reward):
+    add_packs(user_data, 10)
+    return "Hai ricevuto 10 pacchetti! 🎉"
+
+@reward_type("pacchetti", "amount")
+def reward_packs(user_id, user_data, reward):
+    amount = int(reward["amount"])
+    add_packs(user_data, amount)
+    return f"Hai ricevuto {amount} pacchetti! 🎉"
+
+@reward_type("carta_esclusiva", "card_name")
+def reward_exclusive_card(user_id, user_data, reward):
+    card_name = reward["card_name"]
+    if user_data.add("leggendaria", card_name):
+        collection_stats.on_card_added(user_id, "leggendaria", card_name)
+    return f"Hai ricevuto una carta esclusiva: {card_name}! 🎴"
+
+@reward_type("carta_casuale", "rarity")
+def reward_random_card(user_id, user_data, reward):
+    rarity = reward["rarity"]
+    card = random.choice(CARDS[rarity])
+    if user_data.add(rarity, card):
+        collection_stats.on_card_added(user_id, rarity, card)
+        return f"Hai ricevuto una carta {rarity}: {card}! 🎴"
+    return f"Hai ricevuto una carta {rarity} che avevi già: {card}!"
 
-    await update.message.reply_text(
-        f"🃏 **Aperture rimanenti:** {pack_reserve}",
-        parse_mode="Markdown"
-    )
-    
 async def riscatta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Comando /riscatta per riscattare un codice."""
+    """Comando /riscatta per riscattare un codice (condiviso da codes.json o monouso)."""
     user = update.effective_user
     user_id = str(user.id)
 
@@ -354,41 +2800,317 @@ async def riscatta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     code = context.args[0].strip()
-    codes = load_codes_from_github()
+    try:
+        await codes_index.refresh()
+    except Exception as e:
+        # Si continua con i codici già in memoria
+        print(f"Errore nell'aggiornamento dei codici: {e}")
+    if not codes_index.is_valid(code):
+        # Nuovi lotti e riscatti fatti tramite altre istanze del bot (al massimo ogni CODES_REFRESH_INTERVAL secondi)
+        await one_time_codes.refresh()
+
+    # Controllo e riscatto avvengono sotto lock e senza await intermedi, così due /riscatta
+    # concorrenti non possono assegnare il premio due volte
+    async with codes_index.lock:
+        reward = None
+        if codes_index.is_valid(code):
+            if codes_index.is_redeemed(code, user_id):
+                message = "Hai già riscattato questo codice!"
+            else:
+                codes_index.mark_redeemed(code, user_id)
+                reward = codes_index.reward(code)
+                source = codes_index
+        else:
+            outcome, reward = one_time_codes.redeem(code, user_id)
+            source = one_time_codes
+            if outcome == "già_riscattato":
+                message = "Hai già riscattato questo codice!"
+            elif outcome == "esaurito":
+                message = "Questo codice è già stato usato!"
+            elif outcome != "ok":
+                message = "Codice non valido!"
+
+        if reward is not None:
+            # Assegna il premio
+            message = grant_reward(user_id, reward)
+
+    if reward is None:
+        await update.message.reply_text(message)
+        return
+
+    # Salva i codici e le collezioni aggiornate
+    source.schedule_save()
+    save_queue.mark_dirty(user_id)
+    refill_notifier.update(user_id, user_collections[user_id])
+    metrics.inc("sbit_code_redemptions_total", {"tipo": "condiviso" if source is codes_index else "monouso"})
+
+    await update.message.reply_text(message)
+    print(f"L'utente {user_id} ha riscattato il codice {code}.")
+
+def parse_reward_args(name, args):
+    """Premio da argomenti del tipo: pacchetti amount=5, oppure carta_esclusiva card_name=Nome con spazi.
+    Il valore di un parametro continua fino al prossimo chiave=valore."""
+    reward = {"reward": name}
+    key = None
+    for arg in args:
+        if "=" in arg:
+            key, value = arg.split("=", 1)
+            reward[key] = value
+        elif key is not None:
+            reward[key] += f" {arg}"
+        else:
+            raise ValueError(f"Parametro non valido: {arg} (usa chiave=valore)")
+    return reward
+
+async def generacodici(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /generacodici (solo admin): genera un lotto di codici monouso e li invia come file di testo."""
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        await update.message.reply_text("Questo comando è riservato agli amministratori.")
+        return
+
+    usage = ("Uso: /generacodici <quantità> <premio> [usi=N] [parametro=valore ...]\n"
+             f"Premi disponibili: {', '.join(sorted(REWARDS))}")
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+    try:
+        count = int(context.args[0])
+        reward = parse_reward_args(context.args[1], context.args[2:])
+        max_uses = int(reward.pop("usi", 1))
+        batch, codes, digests = await asyncio.to_thread(one_time_codes.mint, count, reward, max_uses)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{usage}")
+        return
 
-    # Verifica se il codice è valido
-    if code not in codes["valid_codes"]:
-        await update.message.reply_text("Codice non valido!")
+    # I codici in chiaro esistono solo in questo file: il lotto su GitHub contiene soltanto gli hash
+    if not await asyncio.to_thread(one_time_codes.publish, batch, digests):
+        await update.message.reply_text("Errore nel salvataggio del lotto su GitHub, nessun codice generato.")
         return
+    document = io.BytesIO("\n".join(codes).encode("utf-8") + b"\n")
+    document.name = f"codici-{batch.batch_id}.txt"
+    await update.message.reply_document(
+        document,
+        caption=f"Lotto {batch.batch_id}: {count} codici ({reward['reward']}, {max_uses} uso/i per codice)."
+    )
+    print(f"Generato il lotto di codici {batch.batch_id} ({count} codici).")
+
+# Dimensione delle miniature delle carte nell'album (le immagini originali sono circa 650x840)
+THUMBNAIL_SIZE = (130, 168)
+THUMBNAIL_DIR = os.environ.get("THUMBNAIL_DIR", os.path.join("cache", "miniature"))
+ALBUM_COLUMNS = 7
+ALBUM_GAP = 8
+ALBUM_BACKGROUND = (24, 24, 32)
+
+# Numero massimo di album renderizzati tenuti in memoria
+ALBUM_CACHE_SIZE = int(os.environ.get("ALBUM_CACHE_SIZE", 64))
+
+# Il rendering degli album gira in questi thread, mai nell'event loop
+album_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="album")
+
+def illustrated_cards():
+    """Carte con un'immagine, nell'ordine del catalogo: lista di (rarità, carta, path)."""
+    return [
+        (rarity, card, entry.image_path)
+        for rarity in RARITIES
+        for card in CARDS.get(rarity, ())
+        for entry in (card_catalog.entry(card),)
+        if entry.has_image
+    ]
 
-    # Recupera i codici riscattati dall'utente
-    user_used_codes = codes["used_codes"].get(user_id, [])
+ALBUM_CARDS = illustrated_cards()
+
+def on_catalog_reload(catalog):
+    """Aggiorna tutto ciò che dipende dal catalogo dopo un ricaricamento."""
+    global CARDS, ESCAPED_CARD_NAMES, pack_sampler, ALBUM_CARDS
+    CARDS = catalog.cards
+    ESCAPED_CARD_NAMES = {name: entry.escaped for name, entry in catalog.entries.items()}
+    pack_sampler = PackSampler(RARITY_PROBABILITIES, CARDS)
+    collection_stats.rebuild(user_collections, CARDS)
+    ALBUM_CARDS = illustrated_cards()
+    collection_pages.clear()
+    if catalog.missing_images:
+        shown = catalog.missing_images[:10]
+        more = len(catalog.missing_images) - len(shown)
+        print(f"Carte senza immagine: {', '.join(shown)}{f' e altre {more}' if more else ''} (elenco completo con /catalogo).")
+
+card_catalog.listeners.append(on_catalog_reload)
+
+class ThumbnailCache:
+    """Miniature delle carte, a colori (possedute) o in grigio (mancanti).
+    Sono indicizzate per hash del contenuto dell'immagine: vengono generate una sola volta,
+    salvate su disco e tenute in memoria per tutti gli album successivi."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, digest, owned):
+        key = (digest, owned)
+        with self._lock:
+            image = self._images.get(key)
+        if image is not None:
+            return image
+
+        thumb_path = os.path.join(self.directory, f"{digest}-{'colore' if owned else 'grigio'}.png")
+        if os.path.isfile(thumb_path):
+            with Image.open(thumb_path) as cached:
+                image = cached.convert("RGB")
+        else:
+            with Image.open(path) as original:
+                image = ImageOps.fit(original.convert("RGB"), THUMBNAIL_SIZE, Image.LANCZOS)
+            if not owned:
+                image = ImageEnhance.Brightness(ImageOps.grayscale(image).convert("RGB")).enhance(0.45)
+            os.makedirs(self.directory, exist_ok=True)
+            # Scrittura atomica: più thread possono generare la stessa miniatura
+            temp_path = f"{thumb_path}.{threading.get_ident()}.tmp"
+            image.save(temp_path, "PNG")
+            os.replace(temp_path, thumb_path)
+
+        with self._lock:
+            self._images[key] = image
+        return image
+
+thumbnails = ThumbnailCache(THUMBNAIL_DIR)
+
+def album_key(entries):
+    """Hash dell'album: cambia solo se cambiano le immagini o le carte possedute."""
+    return hashlib.sha256("|".join(f"{digest}:{int(owned)}" for _, digest, owned in entries).encode("utf-8")).hexdigest()
+
+def render_album(entries):
+    """Compone la griglia dell'album (bloccante). entries è una lista di (path, hash, posseduta). Ritorna un JPEG."""
+    width, height = THUMBNAIL_SIZE
+    columns = min(ALBUM_COLUMNS, len(entries))
+    rows = math.ceil(len(entries) / columns)
+    canvas = Image.new(
+        "RGB",
+        (columns * width + (columns + 1) * ALBUM_GAP, rows * height + (rows + 1) * ALBUM_GAP),
+        ALBUM_BACKGROUND
+    )
+    for position, (path, digest, owned) in enumerate(entries):
+        row, column = divmod(position, columns)
+        canvas.paste(
+            thumbnails.get(path, digest, owned),
+            (ALBUM_GAP + column * (width + ALBUM_GAP), ALBUM_GAP + row * (height + ALBUM_GAP))
+        )
+    buffer = io.BytesIO()
+    canvas.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+class AlbumCache:
+    """Cache LRU degli album renderizzati, indicizzata per album_key.
+    Richieste contemporanee per lo stesso album condividono un unico rendering."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    async def get(self, key, entries):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            return data
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.get_running_loop().run_in_executor(album_executor, render_album, entries)
+            self._pending[key] = pending
+            try:
+                data = await pending
+            finally:
+                del self._pending[key]
+            self._entries[key] = data
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return data
+        return await pending
+
+album_cache = AlbumCache(ALBUM_CACHE_SIZE)
+
+async def album(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /album per vedere le carte illustrate in un'unica immagine, con quelle mancanti in grigio."""
+    user = update.effective_user
+    user_id = str(user.id)
 
-    # Verifica se l'utente ha già riscattato il codice
-    if code in user_used_codes:
-        await update.message.reply_text("Hai già riscattato questo codice!")
+    collection = user_collections.get(user_id)
+    if collection is None or collection.is_empty():
+        await update.message.reply_text("Non hai ancora ottenuto nessuna carta!")
+        return
+    if not ALBUM_CARDS:
+        await update.message.reply_text("Nessuna immagine disponibile per l'album.")
         return
 
-    # Riscatta il codice e assegna il premio
-    reward = codes["valid_codes"][code]
-    if reward["reward"] == "10_pacchetti":
-        user_collections[user_id]["pack_reserve"] += 10
-        await update.message.reply_text("Hai ricevuto 10 pacchetti! 🎉")
-    elif reward["reward"] == "carta_esclusiva":
-        card_name = reward["card_name"]
-        user_collections[user_id]["leggendaria"].append(card_name)
-        await update.message.reply_text(f"Hai ricevuto una carta esclusiva: {card_name}! 🎴")
-
-    # Segna il codice come riscattato dall'utente
-    if user_id not in codes["used_codes"]:
-        codes["used_codes"][user_id] = []
-    codes["used_codes"][user_id].append(code)
+    entries = [(path, file_ids.image_hash(path), collection.has(rarity, card)) for rarity, card, path in ALBUM_CARDS]
+    owned = sum(1 for _, _, is_owned in entries if is_owned)
+    caption = f"📖 Album di {user.first_name}: {owned}/{len(entries)} carte illustrate"
+
+    # Stesso album già inviato: basta il file_id. Una voce per utente, legata all'hash dell'album:
+    # quando l'utente trova una carta l'hash cambia e la voce viene sostituita
+    key = album_key(entries)
+    file_key = f"album:{user.id}"
+    file_id = file_ids.get(file_key, key)
+    if file_id:
+        try:
+            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id, caption=caption)
+            return
+        except BadRequest as e:
+            if not is_stale_file_id(e):
+                raise
+            print(f"file_id dell'album non valido: {e}")
+            file_ids.invalidate(file_key)
+
+    data = await album_cache.get(key, entries)
+    message = await context.bot.send_photo(chat_id=update.effective_chat.id, photo=data, caption=caption)
+    file_ids.put(file_key, key, message.photo[-1].file_id)
+
+# Numero di giocatori mostrati in /classifica e di carte in /statistiche
+LEADERBOARD_SIZE = 10
+
+async def classifica(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /classifica per vedere i migliori collezionisti per completamento."""
+    user_id = str(update.effective_user.id)
+    top = collection_stats.top(LEADERBOARD_SIZE)
+    if not top:
+        await update.message.reply_text("Nessuno ha ancora trovato una carta!")
+        return
 
-    # Salva i codici e le collezioni aggiornate
-    save_codes_to_github(codes)
-    save_collections()
+    total = collection_stats.total_cards
+    lines = ["🏆 Classifica dei collezionisti:\n"]
+    for position, (player_id, owned) in enumerate(top, start=1):
+        name = display_names.get(player_id)
+        lines.append(f"{position}. {name or 'Anonimo'}: {owned / total:.1%} ({owned}/{total})")
+
+    rank = collection_stats.rank(user_id)
+    if rank is not None:
+        owned = collection_stats.owned[user_id]
+        lines.append(f"\nLa tua posizione: {rank}° su {collection_stats.players()} ({owned / total:.1%})")
+
+    await update.message.reply_text("\n".join(lines))
+
+async def statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /statistiche per vedere quanti giocatori possiedono le carte (/statistiche <nome> per cercarne una)."""
+    players = collection_stats.players()
+    if context.args:
+        query = " ".join(context.args).lower()
+        matches = [card for card in collection_stats.owners if query in card.lower()][:LEADERBOARD_SIZE * 2]
+        if not matches:
+            await update.message.reply_text("Nessuna carta trovata con questo nome.")
+            return
+        lines = [f"📊 Possessori su {players} giocatori:\n"]
+        lines += [f"{card}: {collection_stats.owners[card]}" for card in matches]
+        await update.message.reply_text("\n".join(lines))
+        return
 
-    print(f"L'utente {user_id} ha riscattato il codice {code}.")
+    lines = [
+        "📊 Statistiche delle carte:\n",
+        f"Giocatori con almeno una carta: {players}",
+        f"Carte mai trovate: {collection_stats.never_found()} su {collection_stats.total_cards}",
+    ]
+    rarest = collection_stats.rarest_owned(LEADERBOARD_SIZE)
+    if rarest:
+        lines.append("\n💎 Le carte possedute più rare:")
+        lines += [f"{card} ({collection_stats.card_rarity[card]}): {count} giocator{'e' if count == 1 else 'i'}" for count, card in rarest]
+    await update.message.reply_text("\n".join(lines))
 
 async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /about per informazioni sul bot."""
@@ -406,15 +3128,10 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Assicurati che l'utente abbia una collezione, anche vuota
     if user_id not in user_collections:
-        user_collections[user_id] = {
-            "comune": [],
-            "rara": [],
-            "epica": [],
-            "leggendaria": []
-        }
+        user_collections[user_id] = Collection()
 
     # Verifica se l'utente ha carte
-    if not any(user_collections[user_id].values()):
+    if user_collections[user_id].is_empty():
         await update.message.reply_text("Non hai ancora ottenuto nessuna carta!", parse_mode="Markdown")
         return
 
@@ -438,19 +3155,23 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Gestisce i callback dei pulsanti inline."""
     query = update.callback_query
+    if query.data.startswith(COLLECTION_CALLBACK_PREFIX):
+        await show_collection_page(query)
+        return
+
     await query.answer()  # Risponde al clic del pulsante
 
     user_id = str(query.from_user.id)
 
     if query.data == "reset_yes":
         # Resetta la collezione dell'utente
-        user_collections[user_id] = {
-            "comune": [],
-            "rara": [],
-            "epica": [],
-            "leggendaria": []
-        }
-        save_collections()  # Salva la collezione aggiornata
+        old_collection = user_collections.get(user_id)
+        user_collections[user_id] = Collection()
+        # Serve a merge_collection_records: le carte di un'altra istanza non devono tornare dopo il reset
+        user_collections[user_id].meta["reset"] = datetime.now().isoformat()
+        collection_stats.on_collection_replaced(user_id, old_collection, user_collections[user_id])
+        refill_notifier.cancel(user_id)
+        save_queue.mark_dirty(user_id)  # Salva la collezione aggiornata al prossimo flush
 
         await query.edit_message_text(
             f"🎉 La tua collezione è stata resettata!",
@@ -463,11 +3184,182 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             parse_mode="Markdown"
         )
 
-def main():
-    """Avvia il bot."""
-    # Carica le collezioni esistenti
-    load_collections()
+class Startup:
+    """Avvio in background: il webhook risponde subito e gli update restano in coda (when_ready) finché
+    collezioni, codici condivisi, codici monouso e catalogo non sono pronti. I caricamenti da GitHub
+    girano in parallelo e vengono ritentati con backoff: il bot non parte mai con collezioni vuote."""
+
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.verified = False  # True quando le collezioni vengono da uno snapshot verificato (o dall'archivio locale)
+        self.duration = None
+        self._task = None
+
+    def begin(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
 
+    async def _retry(self, name, function):
+        delay = 1
+        while True:
+            try:
+                return await function()
+            except Exception as e:
+                print(f"Avvio: errore nel caricamento di {name}: {e}. Nuovo tentativo tra {delay}s.")
+                metrics.inc("sbit_startup_errors_total", {"fase": name})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, STARTUP_MAX_BACKOFF)
+
+    async def _run(self):
+        start = time.monotonic()
+        results = await asyncio.gather(
+            self._retry("collezioni", lambda: asyncio.to_thread(fetch_collections_state)),
+            # fetch_codes_from_github solleva per ogni errore diverso da 404: si riprova invece di partire senza codici
+            self._retry("codici", lambda: codes_index.refresh(force=True)),
+            # Senza i riscatti già registrati un codice monouso si potrebbe usare due volte
+            self._retry("codici monouso", lambda: asyncio.to_thread(one_time_codes.load)),
+            self._retry("catalogo", card_catalog.reload_if_changed),
+        )
+        # Il thread legge solo i dati: indice delle carte, statistiche e coda di salvataggio si aggiornano
+        # qui nell'event loop, dove gira anche on_catalog_reload
+        apply_collections_state(*results[0])
+        self.verified = True
+        refill_notifier.rebuild(user_collections)
+        self.duration = time.monotonic() - start
+        metrics.set("sbit_startup_seconds", self.duration)
+        self.ready.set()
+        print(f"Avvio completato in {self.duration:.2f}s.")
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+startup = Startup()
+
+metrics_server = None
+
+async def post_init(application: Application) -> None:
+    """Avvia il caricamento dello stato, il salvataggio periodico delle collezioni, il controllo del catalogo
+    e l'endpoint delle metriche."""
+    global metrics_server
+    startup.begin()
+    save_queue.start()
+    card_catalog.start()
+    refill_notifier.start(application.bot)
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(int(METRICS_PORT))
+        print(f"Metriche disponibili su :{METRICS_PORT}/metrics")
+
+async def post_shutdown(application: Application) -> None:
+    """Salva le ultime modifiche prima di chiudere il bot."""
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.stop()
+        metrics_server = None
+    await startup.stop()
+    await card_catalog.stop()
+    await refill_notifier.stop()
+    await save_queue.stop()
+    await codes_index.stop()
+    await one_time_codes.stop()
+    store.close()
+
+async def catalogo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /catalogo (solo admin): ricarica il catalogo se è cambiato e mostra le carte senza immagine."""
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        return
+
+    reloaded = await card_catalog.reload_if_changed()
+    lines = [
+        f"📚 Catalogo {'ricaricato' if reloaded else 'invariato'}: {len(card_catalog.entries)} carte.",
+        *(f"- {RARITY_PLURALS[rarity]}: {len(cards)}" for rarity, cards in card_catalog.cards.items()),
+    ]
+    if card_catalog.missing_images:
+        lines.append(f"\n🖼️ Senza immagine ({len(card_catalog.missing_images)}):")
+        lines += [f"- {name}" for name in card_catalog.missing_images]
+    else:
+        lines.append("\nTutte le carte hanno un'immagine.")
+
+    # L'elenco può superare il limite di un messaggio: lo spezza tra più messaggi
+    message = ""
+    for line in lines:
+        if len(message) + len(line) + 1 > COLLECTION_PAGE_LIMIT:
+            await update.message.reply_text(message)
+            message = ""
+        message += line + "\n"
+    await update.message.reply_text(message)
+
+async def precarica(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /precarica (solo admin) per caricare su Telegram tutte le immagini delle carte e salvarne i file_id."""
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        return
+
+    chat_id = update.effective_chat.id
+    uploaded = 0
+    cached = 0
+    for rarity, cards in CARDS.items():
+        for card in cards:
+            entry = card_catalog.entry(card)
+            if not entry.has_image:
+                continue
+            image_path = entry.image_path
+            if file_ids.get(card, file_ids.image_hash(image_path)):
+                cached += 1
+                continue
+            try:
+                message = await send_cached_photo(context.bot, chat_id, card, image_path, disable_notification=True)
+                await message.delete()
+                uploaded += 1
+            except Exception as e:
+                print(f"Errore durante il caricamento di {card}: {e}")
+            # Rispetta i limiti di Telegram per chat
+            await asyncio.sleep(1)
+
+    await update.message.reply_text(
+        f"Immagini caricate: {uploaded}, già presenti in cache: {cached}."
+    )
+
+def build_application(token, base_url=None):
+    """Crea l'applicazione con tutti i comandi registrati. base_url permette di puntare a un'API Telegram diversa (es. nei benchmark)."""
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(send_scheduler)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+
+    # Aggiungi i comandi
+    application.add_handler(CommandHandler("start", instrumented("start", when_ready(serialized(start)))))
+    application.add_handler(CommandHandler("apri", instrumented("apri", throttled("apri", APRI_COOLDOWN, when_ready(serialized(apri))))))
+    application.add_handler(CommandHandler("collezione", instrumented("collezione", when_ready(serialized(collezione)))))
+    application.add_handler(CommandHandler("pacchetti", instrumented("pacchetti", when_ready(serialized(pacchetti)))))
+    application.add_handler(CommandHandler("notifiche", instrumented("notifiche", when_ready(serialized(notifiche)))))
+    application.add_handler(CommandHandler("help", instrumented("help", when_ready(serialized(help)))))
+    application.add_handler(CommandHandler("bash", instrumented("bash", when_ready(serialized(bash)))))
+    application.add_handler(CommandHandler("riscatta", instrumented("riscatta", when_ready(serialized(riscatta)))))
+    application.add_handler(CommandHandler("about", instrumented("about", when_ready(serialized(about)))))
+    application.add_handler(CommandHandler("album", instrumented("album", when_ready(serialized(album)))))
+    application.add_handler(CommandHandler("classifica", instrumented("classifica", when_ready(serialized(classifica)))))
+    application.add_handler(CommandHandler("statistiche", instrumented("statistiche", when_ready(serialized(statistiche)))))
+    application.add_handler(CommandHandler("reset", instrumented("reset", when_ready(serialized(reset)))))
+    application.add_handler(CommandHandler("precarica", instrumented("precarica", when_ready(serialized(precarica)))))
+    application.add_handler(CommandHandler("catalogo", instrumented("catalogo", when_ready(serialized(catalogo)))))
+    application.add_handler(CommandHandler("generacodici", instrumented("generacodici", when_ready(serialized(generacodici)))))
+    application.add_handler(CallbackQueryHandler(instrumented("button", when_ready(serialized(button)))))
+    return application
+
+def main():
+    """Avvia il bot. Collezioni e codici vengono caricati in background dopo l'avvio (vedi Startup)."""
     # Token e URL del webhook
     TOKEN = os.environ.get("TELEGRAM_TOKEN")
     if not TOKEN:
@@ -478,19 +3370,7 @@ def main():
         raise RuntimeError("APP_URL non configurato!")
 
     # Crea l'applicazione
-    application = Application.builder().token(TOKEN).build()
-
-    # Aggiungi i comandi
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("apri", apri))
-    application.add_handler(CommandHandler("collezione", collezione))
-    application.add_handler(CommandHandler("pacchetti", pacchetti))
-    application.add_handler(CommandHandler("help", help))
-    application.add_handler(CommandHandler("bash", bash))
-    application.add_handler(CommandHandler("riscatta", riscatta))
-    application.add_handler(CommandHandler("about", about))
-    application.add_handler(CommandHandler("reset", reset))
-    application.add_handler(CallbackQueryHandler(button))
+    application = build_application(TOKEN)
 
     # Configura il webhook (modifica l'URL del webhook)
     application.run_webhook(
@@ -0,0 +1,79 @@
+"""Gestione dei codici monouso dalla riga di comando.
+
+Usa la stessa configurazione del bot (GITHUB_TOKEN, CODES_SECRET, ...) e scrive direttamente su GitHub:
+il bot in esecuzione trova i nuovi lotti al primo codice che non conosce.
+
+Uso:
+    python codici.py genera 20000 10_pacchetti --output codici.txt
+    python codici.py genera 500 carta_esclusiva card_name="Nome della carta" --usi 1
+    python codici.py genera 100 pacchetti amount=5 --usi 50
+    python codici.py stato
+    python codici.py compatta
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+
+
+def genera(args):
+    reward = bot.parse_reward_args(args.premio, args.parametri)
+    batch, codes, digests = bot.one_time_codes.mint(args.quantita, reward, args.usi)
+    if not bot.one_time_codes.publish(batch, digests):
+        sys.exit("Errore nel salvataggio del lotto su GitHub, nessun codice generato.")
+    with open(args.output or f"codici-{batch.batch_id}.txt", "w") as file:
+        file.write("\n".join(codes) + "\n")
+    print(f"Lotto {batch.batch_id}: {len(codes)} codici salvati in {file.name}")
+
+
+def stato(args):
+    bot.one_time_codes.require_secret()
+    bot.one_time_codes.load()
+    print(f"\n{'lotto':<24}{'premio':<40}{'usi':>6}{'codici':>9}{'riscatti':>10}")
+    for batch in bot.one_time_codes.batches:
+        reward = ", ".join(f"{key}={value}" for key, value in batch.reward.items() if key != "reward")
+        name = f"{batch.reward['reward']} {reward}".strip()
+        print(f"{batch.batch_id:<24}{name[:38]:<40}{batch.max_uses:>6}{batch.size:>9}{batch.redeemed_count():>10}")
+
+
+def compatta(args):
+    """Unisce tutti i segmenti del log dei riscatti in uno solo e cancella quelli vecchi
+    (il bot lo fa anche da solo, oltre REDEMPTION_COMPACT_THRESHOLD segmenti)."""
+    try:
+        result = bot.compact_redemption_segments()
+    except RuntimeError as e:
+        sys.exit(str(e))
+    if result is None:
+        print("Niente da compattare.")
+        return
+    print(f"{result[0]} segmenti ({result[1]} riscatti) compattati in {result[2]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="comando", required=True)
+
+    parser_genera = commands.add_parser("genera", help="genera un nuovo lotto di codici")
+    parser_genera.add_argument("quantita", type=int, help="numero di codici")
+    parser_genera.add_argument("premio", help=f"tipo di premio ({', '.join(sorted(bot.REWARDS))})")
+    parser_genera.add_argument("parametri", nargs="*", help="parametri del premio, come chiave=valore")
+    parser_genera.add_argument("--usi", type=int, default=1, help="quante volte si può usare ogni codice")
+    parser_genera.add_argument("--output", help="file in cui salvare i codici in chiaro")
+    parser_genera.set_defaults(func=genera)
+
+    commands.add_parser("stato", help="mostra i lotti e quanti codici sono stati riscattati").set_defaults(func=stato)
+    commands.add_parser("compatta", help="unisce i segmenti del log dei riscatti").set_defaults(func=compatta)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
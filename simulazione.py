@@ -0,0 +1,214 @@
+"""Simulatore dell'economia dei pacchetti: quanti pacchetti e quanti giorni servono per completare
+ogni rarità (e l'intero album), e quanti doppioni si trovano lungo la strada.
+
+Usa il catalogo reale (CARDS), l'estrattore di produzione (PackSampler) e la regola di ricarica di
+/apri (refill_reserve), così si possono provare modifiche a probabilità, ricarica o file delle carte
+prima di metterle in produzione. Richiede numpy (non serve al bot: pip install -r requirements-dev.txt).
+
+Due modalità:
+- veloce (predefinita): poissonizzazione. Con i pacchetti che arrivano come processo di Poisson, la
+  prima uscita di ogni carta è un'esponenziale indipendente; il numero di pacchetti per completare un
+  gruppo di carte è |gruppo| + Poisson(somma p_k (tau - T_k) + p_altre * tau), con tau l'ultima prima
+  uscita. La distribuzione è esatta e bastano pochi secondi per milioni di giocatori.
+- esatta (--esatto): apre davvero un pacchetto alla volta per tutti i giocatori con PackSampler.draw_batch.
+  Più lenta, utile per verificare la modalità veloce.
+
+Uso: python simulazione.py [--giocatori 1000000] [--probabilita comune=70,rara=20,epica=7,leggendaria=3]
+                           [--ore-tra-sessioni 12] [--esatto] [--seed 1] [--json risultati.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("Il simulatore richiede numpy: pip install -r requirements-dev.txt")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+
+PERCENTILES = (50, 90, 99)
+
+
+def card_groups(sampler):
+    """Gruppi da completare: ogni rarità più l'album intero, come indici in sampler.flat_cards()."""
+    groups, start = {}, 0
+    for rarity in sampler.rarities:
+        size = len(sampler.cards[rarity])
+        if size:
+            groups[rarity] = np.arange(start, start + size)
+        start += size
+    groups["album"] = np.arange(start)
+    return groups
+
+
+def simulate_fast(sampler, players, rng, block):
+    """Modalità poissonizzata. Ritorna {gruppo: (pacchetti, doppioni)} con un valore per giocatore."""
+    probabilities = np.array(sampler.card_probabilities())
+    groups = card_groups(sampler)
+    results = {name: ([], []) for name in groups}
+    with np.errstate(divide="ignore"):
+        scales = 1 / probabilities  # Le carte con probabilità 0 finiscono nei gruppi non completabili
+    for start in range(0, players, block):
+        size = min(block, players - start)
+        first_hit = rng.exponential(1.0, (size, len(probabilities))) * scales
+        for name, indices in groups.items():
+            group_p = probabilities[indices]
+            if not group_p.all():
+                # Qualche carta non può mai uscire: gruppo non completabile
+                results[name][0].append(np.full(size, -1))
+                results[name][1].append(np.full(size, -1))
+                continue
+            hits = first_hit[:, indices]
+            tau = hits.max(axis=1)
+            duplicates = rng.poisson((group_p * (tau[:, None] - hits)).sum(axis=1))
+            others = rng.poisson(max(0.0, 1 - group_p.sum()) * tau)
+            results[name][0].append(len(indices) + duplicates + others)
+            results[name][1].append(duplicates)
+    return {name: (np.concatenate(packs), np.concatenate(duplicates)) for name, (packs, duplicates) in results.items()}
+
+
+def simulate_exact(sampler, players, rng, block):
+    """Apre un pacchetto alla volta per tutti i giocatori ancora incompleti, con l'estrattore di produzione."""
+    flat = sampler.flat_cards()
+    groups = card_groups(sampler)
+    names = list(groups)
+    group_of_card = np.full(len(flat), -1)
+    for position, name in enumerate(names[:-1]):
+        group_of_card[groups[name]] = position
+    sizes = np.array([len(groups[name]) for name in names])
+
+    packs_out = {name: [] for name in names}
+    duplicates_out = {name: [] for name in names}
+    for start in range(0, players, block):
+        size = min(block, players - start)
+        owned = np.zeros((size, len(flat)), dtype=bool)
+        missing = np.tile(sizes, (size, 1))
+        duplicates = np.zeros((size, len(names)), dtype=np.int64)
+        completed_at = np.full((size, len(names)), -1, dtype=np.int64)
+        active = np.arange(size)
+        opened = 0
+        while active.size:
+            opened += 1
+            _, cards = sampler.draw_batch(active.size, rng)
+            valid = cards >= 0
+            players_hit, cards_hit = active[valid], cards[valid]
+            is_new = ~owned[players_hit, cards_hit]
+            owned[players_hit[is_new], cards_hit[is_new]] = True
+            group = group_of_card[cards_hit]
+            # Doppione o carta nuova: conta sia per la rarità sia per l'album, finché non sono completi
+            for column in (group, np.full_like(group, len(names) - 1)):
+                still_open = completed_at[players_hit, column] < 0
+                np.add.at(missing, (players_hit[is_new & still_open], column[is_new & still_open]), -1)
+                np.add.at(duplicates, (players_hit[~is_new & still_open], column[~is_new & still_open]), 1)
+            just_done = (missing[active] == 0) & (completed_at[active] < 0)
+            rows, columns = np.nonzero(just_done)
+            completed_at[active[rows], columns] = opened
+            active = active[(completed_at[active] < 0).any(axis=1)]
+        for position, name in enumerate(names):
+            packs_out[name].append(completed_at[:, position])
+            duplicates_out[name].append(duplicates[:, position])
+    return {name: (np.concatenate(packs_out[name]), np.concatenate(duplicates_out[name])) for name in names}
+
+
+def refill_schedule(max_packs, session_hours):
+    """Pacchetti cumulativi disponibili a ogni sessione per un giocatore che apre tutto ogni session_hours ore,
+    calcolati con la regola di ricarica di produzione. Ritorna (pacchetti cumulativi, ore dall'inizio)."""
+    reserve, last_opened = bot.INITIAL_PACKS, None
+    now = start = datetime(2024, 1, 1)
+    total, cumulative, hours = 0, [], []
+    while total < max_packs and len(cumulative) < 1000000:
+        reserve, last_opened = bot.refill_reserve(reserve, last_opened, now)
+        total += max(reserve, 0)
+        reserve = min(reserve, 0)
+        cumulative.append(total)
+        hours.append((now - start) / timedelta(hours=1))
+        now += timedelta(hours=session_hours)
+    return np.array(cumulative), np.array(hours)
+
+
+def summarize(values):
+    values = values[values >= 0]
+    if not values.size:
+        return {"media": None, **{f"p{p}": None for p in PERCENTILES}}
+    return {"media": float(values.mean()), **{f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}}
+
+
+def parse_probabilities(text):
+    probabilities = dict(bot.RARITY_PROBABILITIES)
+    for item in text.split(","):
+        rarity, value = item.split("=")
+        if rarity not in probabilities:
+            raise SystemExit(f"Rarità sconosciuta: {rarity}")
+        probabilities[rarity] = int(value)
+    return probabilities
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--giocatori", type=int, default=1000000, help="giocatori simulati")
+    parser.add_argument("--probabilita", help="probabilità alternative, es. comune=70,rara=20,epica=7,leggendaria=3")
+    parser.add_argument("--ore-tra-sessioni", type=float, default=12, help="ogni quante ore il giocatore apre i pacchetti")
+    parser.add_argument("--ricarica", type=int, help=f"pacchetti per ricarica (attuale: {bot.PACKS_PER_REFILL})")
+    parser.add_argument("--intervallo-ricarica", type=float, help=f"ore tra due ricariche (attuale: {bot.REFILL_INTERVAL / timedelta(hours=1):g})")
+    parser.add_argument("--riserva-massima", type=int, help=f"tetto della ricarica (attuale: {bot.MAX_PACK_RESERVE})")
+    parser.add_argument("--esatto", action="store_true", help="apre i pacchetti uno alla volta invece di poissonizzare")
+    parser.add_argument("--blocco", type=int, default=50000, help="giocatori simulati insieme (memoria)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="salva i risultati in un file JSON")
+    args = parser.parse_args()
+
+    if args.ricarica is not None:
+        bot.PACKS_PER_REFILL = args.ricarica
+    if args.intervallo_ricarica is not None:
+        bot.REFILL_INTERVAL = timedelta(hours=args.intervallo_ricarica)
+    if args.riserva_massima is not None:
+        bot.MAX_PACK_RESERVE = args.riserva_massima
+    probabilities = parse_probabilities(args.probabilita) if args.probabilita else bot.RARITY_PROBABILITIES
+    sampler = bot.PackSampler(probabilities, bot.CARDS)
+    rng = np.random.default_rng(args.seed)
+
+    start = time.perf_counter()
+    simulate = simulate_exact if args.esatto else simulate_fast
+    results = simulate(sampler, args.giocatori, rng, args.blocco)
+    elapsed = time.perf_counter() - start
+
+    max_packs = max((int(packs.max()) for packs, _ in results.values() if packs.size), default=0)
+    cumulative, hours = refill_schedule(max_packs, args.ore_tra_sessioni)
+
+    report = {}
+    print(f"\n{args.giocatori} giocatori, modalità {'esatta' if args.esatto else 'veloce'}, {elapsed:.1f}s")
+    print(f"Probabilità: {probabilities}, ricarica +{bot.PACKS_PER_REFILL} ogni "
+          f"{bot.REFILL_INTERVAL / timedelta(hours=1):g}h (max {bot.MAX_PACK_RESERVE}), sessione ogni {args.ore_tra_sessioni:g}h\n")
+    print(f"{'gruppo':<13}{'carte':>6}  {'pacchetti media/p50/p90/p99':>30}  {'giorni media/p50/p90/p99':>28}  {'doppioni media/p50/p90/p99':>30}")
+    for (name, (packs, duplicates)), indices in zip(results.items(), card_groups(sampler).values()):
+        days = hours[np.minimum(np.searchsorted(cumulative, packs), len(hours) - 1)] / 24
+        days[packs < 0] = -1
+        row = {"carte": len(indices), "pacchetti": summarize(packs), "giorni": summarize(days), "doppioni": summarize(duplicates)}
+        report[name] = row
+        cells = [
+            "/".join("-" if row[key][stat] is None else f"{row[key][stat]:.0f}" for stat in ("media", "p50", "p90", "p99"))
+            for key in ("pacchetti", "giorni", "doppioni")
+        ]
+        print(f"{name:<13}{len(indices):>6}  {cells[0]:>30}  {cells[1]:>28}  {cells[2]:>30}")
+
+    # Distribuzione dei doppioni al completamento dell'album, in 10 fasce
+    album_duplicates = results["album"][1]
+    counts, edges = np.histogram(album_duplicates, bins=10)
+    print("\nDoppioni al completamento dell'album:")
+    for count, low, high in zip(counts, edges, edges[1:]):
+        print(f"  {low:>8.0f} - {high:<8.0f} {'#' * int(50 * count / max(counts.max(), 1)):<50} {count / len(album_duplicates):6.1%}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"giocatori": args.giocatori, "probabilita": probabilities, "durata_s": elapsed, "risultati": report}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()